@@ -0,0 +1,96 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compares the per-point dict path previously used by InfluxService with the
+# line-protocol encoder. Run with: python benchmarks/line_protocol.py
+
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ecodan'))
+
+from influxdb.line_protocol import make_lines  # noqa: E402
+
+from clients.ecodan import DummyEcodan  # noqa: E402
+from clients.line_protocol import LineProtocolEncoder, timestamp_ns  # noqa: E402
+from clients.registers import SCHEMA  # noqa: E402
+
+
+def dict_path(sample, timestamp):
+    data = []
+
+    for register in SCHEMA.by_kind['float']:
+        datapoint = sample[register.name]
+        data.append({
+            'time': int(timestamp.strftime('%s')) * 10**9,
+            'measurement': register.stream,
+            'fields': {
+                'value': datapoint.value * 1.0
+            },
+            'tags': {
+                'unit': datapoint.unit
+            }
+        })
+
+    for register in SCHEMA.by_kind['lut']:
+        datapoint = sample[register.name]
+        data.append({
+            'time': int(timestamp.strftime('%s')) * 10**9,
+            'measurement': register.stream,
+            'fields': {
+                'value': datapoint.code
+            },
+            'tags': {
+                'description': datapoint.description
+            }
+        })
+
+    return make_lines({'points': data})
+
+
+def encoder_path(encoder, sample, timestamp):
+    data = []
+    line = encoder.line
+    ts = timestamp_ns(timestamp)
+
+    for register in SCHEMA.by_kind['float']:
+        datapoint = sample[register.name]
+        data.append(line(register.stream, (('unit', datapoint.unit),), datapoint.value * 1.0, ts))
+
+    for register in SCHEMA.by_kind['lut']:
+        datapoint = sample[register.name]
+        data.append(line(register.stream, (('description', datapoint.description),), datapoint.code, ts))
+
+    return '\n'.join(data) + '\n'
+
+
+def main(number=20000):
+    sample = DummyEcodan().read_all()
+    timestamp = datetime.datetime.now().replace(microsecond=0)
+    encoder = LineProtocolEncoder()
+
+    assert dict_path(sample, timestamp) == encoder_path(encoder, sample, timestamp)
+
+    for name, fn in (('dict + make_lines', lambda: dict_path(sample, timestamp)),
+                     ('line protocol encoder', lambda: encoder_path(encoder, sample, timestamp))):
+        best = min(timeit.repeat(fn, number=number, repeat=5))
+        print(f'{name:>24}: {best / number * 10**6:8.2f} us per sample')
+
+
+if __name__ == '__main__':
+    main()
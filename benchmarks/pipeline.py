@@ -0,0 +1,294 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Runs the poll-to-Influx pipeline against the register simulator and a null
+# Influx client, and reports per cycle latency, its split between Modbus,
+# Influx encoding and SQLite state updates, Modbus transactions per poll,
+# event loop blocking and memory allocated per cycle.
+#
+#   python benchmarks/pipeline.py                       # in-memory bus
+#   python benchmarks/pipeline.py --baudrate 9600       # with RS-485 timing
+#   python benchmarks/pipeline.py --transport rtu --baudrate 9600
+#
+# The in-memory bus calls the simulator directly. The rtu and tcp transports
+# run the real Ecodan client against the simulator on a pseudo terminal or a
+# local Modbus TCP server, so framing and timeouts are exercised too.
+
+import argparse
+import asyncio
+import os
+import statistics
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ecodan'))
+
+
+class NullInfluxClient:
+    def __init__(self, *args, **kwargs):
+        self.points = 0
+
+    def write_points(self, data, **kwargs):
+        self.points += len(data)
+
+
+def simulated_devices(args):
+    from simulator import SimulatedEcodan, ThermalModel
+
+    return [SimulatedEcodan(
+        ThermalModel(seed=args.seed),
+        slave=i + 1,
+        baudrate=args.baudrate,
+        latency=args.latency,
+        jitter=args.jitter,
+        time_scale=args.time_scale,
+        seed=args.seed
+    ) for i in range(args.devices)]
+
+
+def simulated_client(args, devices):
+    from clients.ecodan import EcodanBase
+
+    class SimulatedClient(EcodanBase):
+        pipelined = args.pipelined
+
+        def __init__(self, port, slave=1, baudrate=9600, **kwargs):
+            self.device = devices[slave - 1]
+
+        def read_registers(self, registeraddress, number_of_registers, functioncode=3):
+            pdu = struct.pack('>BHH', functioncode, registeraddress, number_of_registers)
+            self.device.delay(len(pdu) + 3)
+            response = self.device.handle(pdu)
+            self.device.delay(len(response) + 3)
+            return list(struct.unpack(f'>{number_of_registers}H', response[2:]))
+
+    return SimulatedClient
+
+
+def serve_devices(args, devices):
+    # Starts the simulator for the chosen transport and returns the port
+    # every device is reached on.
+    from simulator import open_pty, serve_rtu, serve_tcp
+
+    if args.transport == 'rtu':
+        fd, name = open_pty()
+        threading.Thread(target=serve_rtu, args=(devices, fd), daemon=True).start()
+        return f'{name}:{{slave}}:{args.baudrate or 115200}'
+
+    server = serve_tcp(devices, '127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    query = '?pipeline=1' if args.pipelined else ''
+    return f'tcp://127.0.0.1:{server.server_address[1]}{query}:{{slave}}'
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Timer:
+    def __init__(self):
+        self.total = 0
+
+    def wrap(self, fn):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self.total += time.perf_counter() - start
+        return timed
+
+
+class LoopMonitor:
+    # Sleeps in short steps; the time a step oversleeps, beyond the timer
+    # overhead measured on an idle loop, is time the event loop spent running
+    # other callbacks without yielding.
+    def __init__(self, resolution=0.001):
+        self.resolution = resolution
+        self.baseline = 0
+        self.blocked = 0
+        self.worst = 0
+        self.task = None
+
+    async def calibrate(self, steps=200):
+        lags = []
+        for _ in range(steps):
+            start = time.perf_counter()
+            await asyncio.sleep(self.resolution)
+            lags.append(time.perf_counter() - start - self.resolution)
+        self.baseline = percentile(lags, 99)
+
+    async def __run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.resolution)
+            lag = time.perf_counter() - start - self.resolution - self.baseline
+            if lag > 0:
+                self.blocked += lag
+                self.worst = max(self.worst, lag)
+
+    def start(self):
+        self.task = asyncio.get_event_loop().create_task(self.__run())
+
+    def reset(self):
+        self.blocked = self.worst = 0
+
+    def stop(self):
+        self.task.cancel()
+
+
+def report(name, values, unit='ms', scale=1000):
+    print(f'{name:>28}: p50 {percentile(values, 50) * scale:9.2f} {unit}'
+          f'   p99 {percentile(values, 99) * scale:9.2f} {unit}'
+          f'   max {max(values) * scale:9.2f} {unit}')
+
+
+async def run(args, simulated):
+    import main
+    import services.ecodan
+    import services.influx
+
+    app = main.app
+
+    async with app.test_app():
+        ecodan = app.services.ecodan
+        for poll_loop in ecodan.poll_loops:
+            await poll_loop.stop()
+
+        influx = app.services.influx
+        devices = list(ecodan.devices.values())
+
+        modbus, encode, sqlite = Timer(), Timer(), Timer()
+        for device in devices:
+            device.read_registers = modbus.wrap(device.read_registers)
+        influx.flush_states = sqlite.wrap(influx.flush_states)
+        influx.save_ecodan_data = encode.wrap(influx.save_ecodan_data)
+
+        async def poll_all():
+            await asyncio.gather(*(device.read_data_to_influx() for device in devices))
+
+        def transactions():
+            return sum(device.transactions for device in simulated)
+
+        for _ in range(args.warmup):
+            await poll_all()
+        await influx.writer.flush()
+
+        monitor = LoopMonitor()
+        await monitor.calibrate()
+        monitor.start()
+
+        samples = []
+        for _ in range(args.cycles):
+            modbus.total = encode.total = sqlite.total = 0
+            before = transactions()
+            monitor.reset()
+
+            start = time.perf_counter()
+            await poll_all()
+            elapsed = time.perf_counter() - start
+
+            samples.append({
+                'cycle': elapsed,
+                'modbus': modbus.total / len(devices),
+                'encode': encode.total - sqlite.total,
+                'sqlite': sqlite.total,
+                'blocked': monitor.blocked,
+                'worst': monitor.worst,
+                'transactions': (transactions() - before) / len(devices)
+            })
+
+            start = time.perf_counter()
+            await influx.writer.flush()
+            samples[-1]['flush'] = time.perf_counter() - start
+
+        monitor.stop()
+
+        # Tracing slows everything down, so allocations are measured in a
+        # separate pass.
+        tracemalloc.start()
+        allocated, retained = [], []
+        for _ in range(args.alloc_cycles):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            await poll_all()
+            await influx.writer.flush()
+            current, peak = tracemalloc.get_traced_memory()
+            allocated.append(peak - before)
+            retained.append(current - before)
+        tracemalloc.stop()
+
+        points = influx.client.points
+
+    print(f'{len(devices)} device(s) over {args.transport}, {args.cycles} cycles, '
+          f'baudrate {args.baudrate or "unlimited"}, '
+          f'{"pipelined" if args.pipelined else "one request per block"}')
+    report('cycle latency', [s['cycle'] for s in samples])
+    report('modbus (queue + bus)', [s['modbus'] for s in samples])
+    report('influx encoding', [s['encode'] for s in samples])
+    report('sqlite state updates', [s['sqlite'] for s in samples])
+    report('influx flush', [s['flush'] for s in samples])
+    report('event loop blocked', [s['blocked'] for s in samples])
+    report('longest loop stall', [s['worst'] for s in samples])
+    print(f'{"transactions per poll":>28}: {statistics.mean(s["transactions"] for s in samples):9.2f}')
+    print(f'{"points written":>28}: {points:9d}')
+    report('peak allocated per cycle', allocated, 'kB', 1 / 1024)
+    report('retained per cycle', retained, 'kB', 1 / 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the poll-to-Influx pipeline.')
+    parser.add_argument('--cycles', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--alloc-cycles', type=int, default=50)
+    parser.add_argument('--devices', type=int, default=1, help='devices sharing one bus')
+    parser.add_argument('--transport', choices=('memory', 'rtu', 'tcp'), default='memory')
+    parser.add_argument('--baudrate', type=int, default=0, help='0 disables transmission delay')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--time-scale', type=float, default=60)
+    parser.add_argument('--pipelined', action='store_true', help='read all blocks in one worker request')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    simulated = simulated_devices(args)
+    address = 'sim:{slave}' if args.transport == 'memory' else serve_devices(args, simulated)
+
+    os.environ.update(
+        MODBUS_DEVICES=','.join(f'sim{i}@{address.format(slave=i + 1)}' for i in range(args.devices)),
+        MODBUS_POLL_ADAPTIVE='0',
+        MODBUS_HF_INTERVAL='0',
+        INFLUX_BATCH_SIZE='100000',
+        SQLITE_DB_PATH=os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    )
+
+    import services.ecodan
+    import services.influx
+
+    if args.transport == 'memory':
+        services.ecodan.Ecodan = simulated_client(args, simulated)
+    services.influx.InfluxClient = NullInfluxClient
+
+    asyncio.run(run(args, simulated))
+
+
+if __name__ == '__main__':
+    main()
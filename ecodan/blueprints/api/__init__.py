@@ -14,27 +14,264 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from quart import Blueprint, request, current_app as app
+import datetime
+import json
+
+from quart import Blueprint, abort, request, make_response, current_app as app
 from quart_auth import basic_auth_required
 
+import minimalmodbus
+
+from clients.ecodan import RETRYABLE_ERRORS
+from services.ecodan import serialize
+
 api = Blueprint('api', __name__)
 
 
+def get_device():
+    device_id = request.args.get('device')
+    device = app.services.ecodan.device(device_id)
+
+    if device is None:
+        abort(404, description=f'Unknown device: {device_id}')
+    return device
+
+
+async def conditional_response(body, etag):
+    if etag in request.if_none_match:
+        response = await make_response('', 304)
+    else:
+        response = await make_response(body)
+
+    response.set_etag(etag)
+    return response
+
+
+@api.errorhandler(404)
+async def not_found(e):
+    return {
+        'status': 'error',
+        'message': e.description
+    }, 404
+
+
+@api.get("/devices")
+@basic_auth_required()
+async def get_devices():
+    return {
+        'devices': list(app.services.ecodan.devices)
+    }
+
+
+@api.get("/state")
+@basic_auth_required()
+async def get_state():
+    snapshot = get_device().snapshot
+    return await conditional_response(snapshot.to_dict(), snapshot.etag)
+
+
+@api.get("/state/<name>")
+@basic_auth_required()
+async def get_state_field(name):
+    snapshot_field = get_device().snapshot.fields.get(name)
+
+    if snapshot_field is None:
+        return {
+            'status': 'error',
+            'message': f'Unknown or not yet read field: {name}'
+        }, 404
+
+    return await conditional_response(snapshot_field.to_dict(), snapshot_field.etag)
+
+
+@api.get("/live/<name>")
+@basic_auth_required()
+async def get_live_field(name):
+    device = get_device()
+
+    if name not in device.client.schema.by_name:
+        return {
+            'status': 'error',
+            'message': f'Unknown field: {name}'
+        }, 404
+
+    code = 503
+    try:
+        values = await device.read_cached((name,))
+    except RETRYABLE_ERRORS as e:
+        values = {}
+        message = str(e)
+    except minimalmodbus.ModbusException as e:
+        # The heat pump answered, but refused the request.
+        values = {}
+        message = str(e)
+        code = 502
+    else:
+        message = 'No valid response from the heat pump'
+
+    if name not in values:
+        return {
+            'status': 'error',
+            'message': f'Could not read {name}: {message}'
+        }, code
+
+    return serialize(values[name])
+
+
+@api.get("/stream")
+@basic_auth_required()
+async def stream_state():
+    if request.args.get('device'):
+        devices = [get_device()]
+    else:
+        devices = list(app.services.ecodan.devices.values())
+
+    broadcaster = app.services.ecodan.broadcaster
+    subscription = broadcaster.subscribe()
+    versions = {device.id: device.snapshot.version for device in devices}
+
+    def event(message):
+        return f"data: {json.dumps(message)}\n\n".encode()
+
+    async def events():
+        try:
+            for device in devices:
+                snapshot = device.snapshot
+                yield event({'device': device.id, 'version': snapshot.version, 'fields': snapshot.to_dict()})
+
+            while True:
+                message = await subscription.get()
+                if message is None:
+                    break
+                if message['version'] > versions.get(message['device'], message['version']):
+                    yield event(message)
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+    response = await make_response(events(), {
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    response.timeout = None
+    return response
+
+
+# Query ranges up to this many hours are served from the 1-minute rollup.
+HISTORY_MINUTE_RANGE = 6
+
+HISTORY_RESOLUTIONS = {
+    'raw': 'raw',
+    '1m': 60,
+    '1h': 3600
+}
+
+
+@api.get("/history")
+@basic_auth_required()
+async def get_history():
+    device = get_device()
+    name = request.args.get('name')
+
+    if name is None:
+        return {
+            'status': 'error',
+            'message': 'name is required'
+        }, 400
+
+    if name not in device.client.schema.by_name:
+        return {
+            'status': 'error',
+            'message': f'Unknown field: {name}'
+        }, 404
+
+    try:
+        end = datetime.datetime.fromisoformat(request.args['end']) \
+            if 'end' in request.args else datetime.datetime.now()
+        start = datetime.datetime.fromisoformat(request.args['start']) \
+            if 'start' in request.args else end - datetime.timedelta(days=1)
+    except ValueError as e:
+        return {
+            'status': 'error',
+            'message': str(e)
+        }, 400
+
+    resolution = request.args.get('resolution', 'auto')
+    if resolution == 'auto':
+        resolution = '1m' if end - start <= datetime.timedelta(hours=HISTORY_MINUTE_RANGE) else '1h'
+    if resolution not in HISTORY_RESOLUTIONS:
+        return {
+            'status': 'error',
+            'message': f'Unknown resolution: {resolution}'
+        }, 400
+
+    points = await app.services.history.query(
+        device.id, name, start.timestamp(), end.timestamp(), HISTORY_RESOLUTIONS[resolution])
+
+    for point in points:
+        point['time'] = datetime.datetime.fromtimestamp(point['time']).isoformat()
+
+    return {
+        'device': device.id,
+        'name': name,
+        'unit': getattr(device.client.schema[name], 'unit', ''),
+        'resolution': resolution,
+        'points': points
+    }
+
+
+@api.get("/samples")
+@basic_auth_required()
+async def get_samples():
+    device = get_device()
+
+    try:
+        start = datetime.datetime.fromisoformat(request.args['start']).timestamp() \
+            if 'start' in request.args else None
+        end = datetime.datetime.fromisoformat(request.args['end']).timestamp() \
+            if 'end' in request.args else None
+    except ValueError as e:
+        return {
+            'status': 'error',
+            'message': str(e)
+        }, 400
+
+    samples = device.samples.window(start, end).to_dict()
+    samples['time'] = [datetime.datetime.fromtimestamp(t).isoformat() for t in samples['time']]
+
+    return {
+        'device': device.id,
+        'units': {name: device.client.schema[name].unit for name in device.samples.fields},
+        'samples': samples
+    }
+
+
 @api.put("/tank/target_temp")
 @basic_auth_required()
 async def set_tank_target_temp():
     data = await request.get_json()
 
     try:
-        app.services.ecodan.client.set_tank_target_temp(data['value'])
+        latency = await get_device().set_tank_target_temp(data['value'])
     except (ValueError, TypeError, KeyError) as e:
         return {
             'status': 'error',
             'message': str(e)
         }, 400
+    except RETRYABLE_ERRORS as e:
+        return {
+            'status': 'error',
+            'message': f'Could not write tank_target_temp: {e}'
+        }, 503
+    except minimalmodbus.ModbusException as e:
+        return {
+            'status': 'error',
+            'message': f'Heat pump refused to write tank_target_temp: {e}'
+        }, 502
     else:
         return {
-            'status': 'ok'
+            'status': 'ok',
+            'latency_ms': round(latency, 1)
         }
 
 
@@ -44,13 +281,24 @@ async def set_house_target_temp():
     data = await request.get_json()
 
     try:
-        app.services.ecodan.client.set_house_target_temp(data['value'])
+        latency = await get_device().set_house_target_temp(data['value'])
     except (ValueError, TypeError, KeyError) as e:
         return {
             'status': 'error',
             'message': str(e)
         }, 400
+    except RETRYABLE_ERRORS as e:
+        return {
+            'status': 'error',
+            'message': f'Could not write house_target_temp: {e}'
+        }, 503
+    except minimalmodbus.ModbusException as e:
+        return {
+            'status': 'error',
+            'message': f'Heat pump refused to write house_target_temp: {e}'
+        }, 502
     else:
         return {
-            'status': 'ok'
+            'status': 'ok',
+            'latency_ms': round(latency, 1)
         }
@@ -14,7 +14,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from quart import Blueprint
+from quart import Blueprint, current_app as app
+
+from clients.registers import SCHEMA
+from metrics import REGISTRY, Gauge
 
 status = Blueprint('status', __name__)
 
@@ -24,3 +27,25 @@ async def health():
     return {
         'status': 'ok'
     }
+
+
+def value_gauges():
+    gauges = {
+        register.name: Gauge(f'ecodan_{register.stream}', f'Last polled {register.name}.', ('device', 'unit'))
+        for register in SCHEMA.registers
+    }
+
+    for device in app.services.ecodan.devices.values():
+        for name, snapshot_field in device.snapshot.fields.items():
+            register = SCHEMA[name]
+            unit = getattr(snapshot_field.data, 'unit', '')
+            gauges[name].labels(device.id, unit).set(register.value_of(snapshot_field.data))
+
+    return [gauge for gauge in gauges.values() if gauge.children]
+
+
+@status.get("/metrics")
+async def metrics():
+    return REGISTRY.expose(value_gauges()), 200, {
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'
+    }
@@ -14,325 +14,143 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from dataclasses import dataclass
-import datetime
+import time
+
 import minimalmodbus
+import serial
 
+from clients.registers import SCHEMA, EcodanFloatData, EcodanEnergyData, EcodanLutData, encode_register
+from clients.transports import create_transport
+from metrics import MODBUS_ERRORS, MODBUS_SECONDS, MODBUS_TRANSACTIONS
 
-@dataclass
-class EcodanFloatData:
-    value: float
-    unit: str
 
+# Bus level failures that may not happen on a second attempt. Other errors
+# reported by the slave, such as an illegal address, fail the same way again.
+RETRYABLE_ERRORS = (
+    minimalmodbus.MasterReportedException,
+    minimalmodbus.SlaveDeviceBusyError,
+    serial.SerialException,
+    ConnectionError,
+    TimeoutError
+)
 
-@dataclass
-class EcodanLutData:
-    code: int
-    description: str
+# Everything a read or write can fail with on the device side, including
+# requests the slave refuses.
+DEVICE_ERRORS = RETRYABLE_ERRORS + (minimalmodbus.ModbusException,)
 
 
-@dataclass
-class EcodanEnergyData:
-    value: float
-    unit: str
-    date: datetime.date
+def error_kind(e):
+    if isinstance(e, minimalmodbus.NoResponseError):
+        return 'timeout'
+    if isinstance(e, minimalmodbus.InvalidResponseError):
+        return 'crc' if str(e).startswith('Checksum error') else 'invalid_response'
+    if isinstance(e, minimalmodbus.SlaveReportedException):
+        return 'slave_exception'
+    return type(e).__name__
 
 
-class DummyEcodan:
-    def __init__(self, *args, **kwargs):
-        self.tank_target_temp = 0
+class EcodanBase:
+    schema = SCHEMA
 
-    def get_tank_target_temp(self):
-        value = self.tank_target_temp
-        unit = '°C'
-        return EcodanFloatData(value, unit)
+    pipelined = False
 
-    def set_tank_target_temp(self, value):
-        if type(value) not in (int, float):
-            raise TypeError("Value must be numeric.")
-
-        if value < 10 or value > 60:
-            raise ValueError("Value must be between 10 and 60 (inclusive).")
-
-        print(f'Setting target temp to {value}')
-        self.tank_target_temp = value
-
-    def get_tank_temp(self):
-        value = 42
-        unit = '°C'
-        return EcodanFloatData(value, unit)
-
-    def get_house_temp(self):
-        value = 22.5
-        unit = '°C'
-        return EcodanFloatData(value, unit)
-
-    def get_house_target_temp(self):
-        value = 21
-        unit = '°C'
-        return EcodanFloatData(value, unit)
-
-    def get_outdoor_temp(self):
-        value = 14.5
-        unit = '°C'
-        return EcodanFloatData(value, unit)
-
-    def get_pump_freq(self):
-        value = 38
-        unit = 'Hz'
-        return EcodanFloatData(value, unit)
-
-    def get_flow(self):
-        value = 19
-        unit = 'l/min'
-        return EcodanFloatData(value, unit)
-
-    def get_pump_supply_temp(self):
-        value = 50
-        unit = '°C'
-        return EcodanFloatData(value, unit)
-
-    def get_pump_return_temp(self):
-        value = 45
-        unit = '°C'
-        return EcodanFloatData(value, unit)
-
-    def get_energy_consumed_tank(self):
-        kwh_part = 3
-        wh_part = 260
-        value = kwh_part + (wh_part/1000)
-        unit = 'kWh'
-
-        year = 2023
-        month = 9
-        day = 1
-        date = datetime.date(year, month, day)
-
-        return EcodanEnergyData(value, unit, date)
-
-    def get_energy_consumed_house(self):
-        kwh_part = 3
-        wh_part = 170
-        value = kwh_part + (wh_part/1000)
-        unit = 'kWh'
-
-        year = 2023
-        month = 9
-        day = 1
-        date = datetime.date(year, month, day)
-
-        return EcodanEnergyData(value, unit, date)
-
-    def get_energy_produced_tank(self):
-        kwh_part = 9
-        wh_part = 560
-        value = kwh_part + (wh_part/1000)
-        unit = 'kWh'
-
-        year = 2023
-        month = 9
-        day = 1
-        date = datetime.date(year, month, day)
-
-        return EcodanEnergyData(value, unit, date)
-
-    def get_energy_produced_house(self):
-        kwh_part = 0
-        wh_part = 180
-        value = kwh_part + (wh_part/1000)
-        unit = 'kWh'
-
-        year = 2023
-        month = 9
-        day = 1
-        date = datetime.date(year, month, day)
-
-        return EcodanEnergyData(value, unit, date)
-
-
-class Ecodan(minimalmodbus.Instrument):
-    def __init__(self, port, slave=1, baudrate=9600, *args, **kwargs):
-        super().__init__(port, slave, *args, **kwargs)
-        self.serial.baudrate = baudrate
-
-    def get_tank_target_temp(self):
-        value = self.read_register(31, 2)
-        unit = '°C'
-        return EcodanFloatData(value, unit)
+    def read_registers_many(self, blocks):
+        return [self.read_registers(start, count) for start, count in blocks]
 
-    def set_tank_target_temp(self, value):
-        if type(value) not in (int, float):
-            raise TypeError("Value must be numeric.")
+    def read_blocks(self, plan=None):
+        plan = plan or self.schema.read_plan
 
-        if value < 10 or value > 60:
-            raise ValueError("Value must be between 10 and 60 (inclusive).")
+        registers = {}
+        for (start, count), values in zip(plan, self.read_registers_many(plan)):
+            registers.update(zip(range(start, start + count), values))
+        return registers
 
-        self.write_register(31, value, 2)
+    def read_value(self, name):
+        register = self.schema[name]
 
-    def get_tank_temp(self):
-        value = self.read_register(106, 2)
-        unit = '°C'
-        return EcodanFloatData(value, unit)
+        return self.schema.decoder_by_name[name](self.read_blocks(self.schema.plan((register,))))
 
-    def get_house_temp(self):
-        value = self.read_register(94, 2)
-        unit = '°C'
-        return EcodanFloatData(value, unit)
+    def read_all(self):
+        return self.schema.decode(self.read_blocks())
 
-    def get_house_target_temp(self):
-        value = self.read_register(55, 2)
-        unit = '°C'
-        return EcodanFloatData(value, unit)
+    def write_value(self, name, value):
+        register = self.schema[name]
+        register.validate(value)
+        self.write_register(register.address, value, register.decimals, signed=register.signed)
+
+    def set_tank_target_temp(self, value):
+        self.write_value('tank_target_temp', value)
 
     def set_house_target_temp(self, value):
-        if type(value) not in (int, float):
-            raise TypeError("Value must be numeric.")
-
-        if value < 5 or value > 25:
-            raise ValueError("Value must be between 5 and 25 (inclusive).")
-
-        self.write_register(55, value, 2)
-
-    def get_outdoor_temp(self):
-        value = self.read_register(99, 1, signed=True)
-        unit = '°C'
-        return EcodanFloatData(value, unit)
-
-    def get_pump_freq(self):
-        value = self.read_register(73)
-        unit = 'Hz'
-        return EcodanFloatData(value, unit)
-
-    def get_flow(self):
-        value = self.read_register(299)
-        unit = 'l/min'
-        return EcodanFloatData(value, unit)
-
-    def get_pump_supply_temp(self):
-        value = self.read_register(102, 2)
-        unit = '°C'
-        return EcodanFloatData(value, unit)
-
-    def get_pump_return_temp(self):
-        value = self.read_register(104, 2)
-        unit = '°C'
-        return EcodanFloatData(value, unit)
-
-    def get_energy_consumed_tank(self):
-        kwh_part = self.read_register(286)
-        wh_part = self.read_register(287) * 10
-        value = kwh_part + (wh_part/1000)
-        unit = 'kWh'
-
-        year = 2000 + self.read_register(279)
-        month = self.read_register(280)
-        day = self.read_register(281)
-        date = datetime.date(year, month, day)
-
-        return EcodanEnergyData(value, unit, date)
-
-    def get_energy_consumed_house(self):
-        kwh_part = self.read_register(282)
-        wh_part = self.read_register(283) * 10
-        value = kwh_part + (wh_part/1000)
-        unit = 'kWh'
-
-        year = 2000 + self.read_register(279)
-        month = self.read_register(280)
-        day = self.read_register(281)
-        date = datetime.date(year, month, day)
-
-        return EcodanEnergyData(value, unit, date)
-
-    def get_energy_produced_tank(self):
-        kwh_part = self.read_register(296)
-        wh_part = self.read_register(297) * 10
-        value = kwh_part + (wh_part/1000)
-        unit = 'kWh'
-
-        year = 2000 + self.read_register(289)
-        month = self.read_register(290)
-        day = self.read_register(291)
-        date = datetime.date(year, month, day)
-
-        return EcodanEnergyData(value, unit, date)
-
-    def get_energy_produced_house(self):
-        kwh_part = self.read_register(292)
-        wh_part = self.read_register(293) * 10
-        value = kwh_part + (wh_part/1000)
-        unit = 'kWh'
-
-        year = 2000 + self.read_register(289)
-        month = self.read_register(290)
-        day = self.read_register(291)
-        date = datetime.date(year, month, day)
-
-        return EcodanEnergyData(value, unit, date)
-
-    def get_operating_mode(self):
-        mode = self.read_register(26)
-
-        operating_modes = {
-            0: 'Stop',
-            1: 'Hot water',
-            2: 'Heating',
-            3: 'Cooling',
-            4: 'No voltage contact input (hot water storage)',
-            5: 'Freeze stat',
-            6: 'Legionella',
-            7: 'Heating eco',
-            8: 'Mode 1',
-            9: 'Mode 2',
-            10: 'Mode 3',
-            11: 'No voltage contact input (heating up)'
-        }
+        self.write_value('house_target_temp', value)
 
-        return EcodanLutData(
-            code=mode,
-            description=operating_modes.get(mode, 'Unknown')
-        )
 
-    def get_heat_source(self):
-        heat_source = self.read_register(80)
+def _getter(name):
+    def get(self):
+        return self.read_value(name)
+
+    get.__name__ = f'get_{name}'
+    return get
 
-        heat_sources = {
-            0: 'Heatpump',
-            1: 'Immersion heater',
-            2: 'Backup heater',
-            3: 'Immersion and backup heater',
-            4: 'Boiler'
-        }
 
-        return EcodanLutData(
-            code=heat_source,
-            description=heat_sources.get(heat_source, 'Unknown')
-        )
+for _register in SCHEMA.registers:
+    setattr(EcodanBase, f'get_{_register.name}', _getter(_register.name))
 
-    def get_defrost_status(self):
-        defrost_status = self.read_register(67)
 
-        defrost_statuses = {
-            0: 'Normal',
-            1: 'Standby',
-            2: 'Defrost',
-            3: 'Waiting restart'
+class DummyEcodan(EcodanBase):
+    def __init__(self, *args, **kwargs):
+        self.registers = {
+            26: 0, 31: 0, 39: 0, 55: 2100, 67: 0, 73: 38, 80: 0,
+            94: 2250, 99: 145, 102: 5000, 104: 4500, 106: 4200,
+            279: 23, 280: 9, 281: 1, 282: 3, 283: 17, 286: 3, 287: 26,
+            289: 23, 290: 9, 291: 1, 292: 0, 293: 18, 296: 9, 297: 56,
+            299: 19
         }
 
-        return EcodanLutData(
-            code=defrost_status,
-            description=defrost_statuses.get(defrost_status, 'Unknown')
-        )
+    def read_registers(self, registeraddress, number_of_registers, functioncode=3):
+        return [self.registers.get(a, 0)
+                for a in range(registeraddress, registeraddress + number_of_registers)]
 
-    def get_dhw_enabled(self):
-        dhw_enabled = self.read_register(39)
+    def write_register(self, registeraddress, value, number_of_decimals=0, functioncode=16, signed=False):
+        print(f'Setting register {registeraddress} to {value}')
+        self.registers[registeraddress] = encode_register(value, number_of_decimals, signed)
 
-        dhw_status = {
-            0: 'Enabled',
-            1: 'Disabled'
-        }
 
-        return EcodanLutData(
-            code=dhw_enabled,
-            description=dhw_status.get(dhw_enabled, 'Unknown')
-        )
+class Ecodan(EcodanBase):
+    def __init__(self, port, slave=1, baudrate=9600, device_id=None, **kwargs):
+        self.transport = create_transport(port, slave, baudrate, **kwargs)
+        self.pipelined = self.transport.pipelined
+
+        device_id = device_id or f'{port}:{slave}'
+        self.metrics = {
+            operation: (
+                MODBUS_SECONDS.labels(device_id, operation),
+                MODBUS_TRANSACTIONS.labels(device_id, operation)
+            ) for operation in ('read', 'write')
+        }
+        self.device_id = device_id
+
+    def __measure(self, operation, transactions, fn, *args):
+        seconds, count = self.metrics[operation]
+        count.inc(transactions)
+
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        except Exception as e:
+            MODBUS_ERRORS.labels(self.device_id, operation, error_kind(e)).inc()
+            raise
+        finally:
+            seconds.observe(time.perf_counter() - start)
+
+    def read_registers(self, registeraddress, number_of_registers, functioncode=3):
+        return self.__measure(
+            'read', 1, self.transport.read_registers, registeraddress, number_of_registers, functioncode)
+
+    def read_registers_many(self, blocks):
+        return self.__measure('read', len(blocks), self.transport.read_registers_many, blocks)
+
+    def write_register(self, registeraddress, value, number_of_decimals=0, functioncode=16, signed=False):
+        self.__measure(
+            'write', 1, self.transport.write_register,
+            registeraddress, value, number_of_decimals, functioncode, signed)
@@ -14,17 +14,133 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import time
+
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
+
+from db.models.influx_spool import InfluxSpool
+from metrics import INFLUX_POINTS, INFLUX_WRITE_SECONDS
 
 
 class DummyInfluxClient:
     def __init__(*args, **kwargs):
         pass
 
-    def write_points(self, data):
+    def write_points(self, data, **kwargs):
         print(data)
 
 
 class InfluxClient(InfluxDBClient):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+
+
+class InfluxWriter:
+    def __init__(self, client, batch_size=500, flush_interval=10, retry_interval=60):
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='influx')
+        self.buffer = []
+        self.lock = asyncio.Lock()
+        self.flush_needed = asyncio.Event()
+        self.retry_at = 0
+        self.unavailable = False
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_event_loop().create_task(self.__run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+        await self.flush()
+        self.executor.shutdown(wait=True)
+
+    def write(self, points):
+        self.buffer.extend(points)
+        if len(self.buffer) >= self.batch_size:
+            self.flush_needed.set()
+
+    async def flush(self):
+        async with self.lock:
+            points, self.buffer = self.buffer, []
+
+            # Spooled points are older than the buffer, so they go first.
+            if await self.__replay_spool():
+                for i in range(0, len(points), self.batch_size):
+                    if not await self.__write_batch(points[i:i + self.batch_size]):
+                        await InfluxSpool.push(points[i:])
+                        INFLUX_POINTS.labels('spooled').inc(len(points) - i)
+                        break
+            elif points:
+                await InfluxSpool.push(points)
+                INFLUX_POINTS.labels('spooled').inc(len(points))
+
+    async def __run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_needed.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self.flush_needed.clear()
+            await self.flush()
+
+    async def __replay_spool(self):
+        while True:
+            rows = await InfluxSpool.peek(self.batch_size)
+            if not rows:
+                return True
+
+            if not await self.__write_batch([row.payload for row in rows]):
+                return False
+            await InfluxSpool.delete_until(rows[-1].id)
+
+    async def __write_batch(self, points):
+        if time.monotonic() < self.retry_at:
+            return False
+
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        try:
+            await loop.run_in_executor(
+                self.executor, lambda: self.client.write_points(points, protocol='line'))
+        except InfluxDBClientError as e:
+            if e.code is not None and 400 <= e.code < 500:
+                # Influx rejected the points themselves, retrying will not help.
+                print(f'Dropping {len(points)} points rejected by Influx: {e}')
+                INFLUX_POINTS.labels('dropped').inc(len(points))
+                return True
+            self.__retry_later(e)
+            return False
+        except Exception as e:
+            self.__retry_later(e)
+            return False
+        finally:
+            INFLUX_WRITE_SECONDS.labels().observe(time.perf_counter() - start)
+
+        if self.unavailable:
+            print('Influx is available again')
+            self.unavailable = False
+
+        INFLUX_POINTS.labels('written').inc(len(points))
+        return True
+
+    def __retry_later(self, e):
+        if not self.unavailable:
+            print(f'Influx is unavailable, spooling points and retrying every {self.retry_interval}s: {e}')
+            self.unavailable = True
+        self.retry_at = time.monotonic() + self.retry_interval
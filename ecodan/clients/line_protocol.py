@@ -0,0 +1,58 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+def escape_key(value):
+    return str(value).replace('\\', '\\\\').replace(' ', '\\ ').replace(',', '\\,') \
+        .replace('=', '\\=').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return str(value)
+    if isinstance(value, int):
+        return f'{value}i'
+    return repr(float(value))
+
+
+def timestamp_ns(timestamp):
+    # Millisecond precision, finer would only repeat the serial bus jitter.
+    return int(timestamp.timestamp() * 1000) * 10**6
+
+
+class LineProtocolEncoder:
+    def __init__(self):
+        self.prefixes = {}
+
+    def prefix(self, measurement, tags=(), field='value'):
+        key = (measurement, tags, field)
+        prefix = self.prefixes.get(key)
+
+        if prefix is None:
+            prefix = escape_key(measurement) + ''.join(
+                f',{escape_key(k)}={escape_key(v)}' for k, v in sorted(tags) if v != '')
+            prefix += f' {escape_key(field)}='
+            self.prefixes[key] = prefix
+
+        return prefix
+
+    def line(self, measurement, tags, value, timestamp):
+        return f'{self.prefix(measurement, tags)}{format_value(value)} {timestamp}'
+
+    def fields_line(self, measurement, tags, fields, timestamp):
+        items = sorted(fields.items())
+        first_field, first_value = items[0]
+        rest = ''.join(f',{escape_key(k)}={format_value(v)}' for k, v in items[1:])
+        return f'{self.prefix(measurement, tags, first_field)}{format_value(first_value)}{rest} {timestamp}'
@@ -0,0 +1,92 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import time
+
+
+class RegisterCache:
+    def __init__(self, schema, read):
+        self.schema = schema
+        self.read = read
+
+        self.values = {}
+        self.inflight = {}
+        # Bumped on every write, so values read before it are not cached.
+        self.generations = {}
+
+    def generation(self, names):
+        return {name: self.generations.get(name, 0) for name in names}
+
+    def put(self, values, now=None, generation=None):
+        # Returns the values that are still current and were cached.
+        now = time.monotonic() if now is None else now
+        if generation is not None:
+            values = {name: data for name, data in values.items()
+                      if generation.get(name, 0) == self.generations.get(name, 0)}
+
+        for name, data in values.items():
+            ttl = self.schema[name].ttl
+            self.values[name] = (data, None if ttl is None else now + ttl)
+        return values
+
+    def invalidate(self, address):
+        for register in self.schema.registers:
+            if address in register.addresses:
+                self.values.pop(register.name, None)
+                self.inflight.pop(register.name, None)
+                self.generations[register.name] = self.generations.get(register.name, 0) + 1
+
+    async def get(self, names):
+        now = time.monotonic()
+
+        result = {}
+        pending = set()
+        missing = []
+        for name in names:
+            data, expires = self.values.get(name, (None, 0))
+            if expires is None or expires > now:
+                result[name] = data
+            elif name in self.inflight:
+                pending.add(self.inflight[name])
+            else:
+                missing.append(name)
+
+        if missing:
+            task = asyncio.ensure_future(self.__fetch(missing))
+            for name in missing:
+                self.inflight[name] = task
+            pending.add(task)
+
+        # Shielded, so a cancelled caller does not cancel the read for the
+        # others waiting on it.
+        for values in await asyncio.gather(*(asyncio.shield(task) for task in pending)):
+            result.update((name, values[name]) for name in names if name in values)
+
+        return result
+
+    async def __fetch(self, names):
+        generation = self.generation(names)
+        try:
+            registers, _ = await self.read(self.schema.plan_for(names))
+            values, _ = self.schema.decode_partial(registers, names)
+            self.put(values, generation=generation)
+            return values
+        finally:
+            task = asyncio.current_task()
+            for name in names:
+                if self.inflight.get(name) is task:
+                    del self.inflight[name]
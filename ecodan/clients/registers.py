@@ -0,0 +1,328 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from dataclasses import dataclass
+import datetime
+
+
+@dataclass(slots=True)
+class EcodanFloatData:
+    value: float
+    unit: str
+
+
+@dataclass(slots=True)
+class EcodanLutData:
+    code: int
+    description: str
+
+
+@dataclass(slots=True)
+class EcodanEnergyData:
+    value: float
+    unit: str
+    date: datetime.date
+
+
+# Largest distance between two wanted registers that is still bridged by
+# reading the unused registers in between, and the Modbus limit for a
+# single 'read holding registers' request.
+MAX_READ_GAP = 15
+MAX_READ_COUNT = 125
+
+
+def plan_reads(addresses, max_gap=MAX_READ_GAP, max_count=MAX_READ_COUNT):
+    blocks = []
+    start = end = None
+
+    for address in sorted(set(addresses)):
+        if start is not None and address - end <= max_gap and address - start < max_count:
+            end = address
+            continue
+
+        if start is not None:
+            blocks.append((start, end - start + 1))
+        start = end = address
+
+    if start is not None:
+        blocks.append((start, end - start + 1))
+
+    return blocks
+
+
+# Default (fastest, slowest) poll interval in seconds. The adaptive poll
+# scheduler moves each register between these bounds.
+POLL_DEFAULT = (30, 300)
+
+# Register 'ttl' is how long, in seconds, an on-demand read is served from
+# the register cache; None caches until the register is written.
+
+# Register 'tolerance' is the change that matters: smaller changes neither
+# speed up polling nor get written to Influx, until the 'heartbeat' interval
+# in seconds has passed since the last written point.
+HEARTBEAT_DEFAULT = 900
+
+
+def decode_register(raw, decimals=0, signed=False):
+    if signed and raw >= 0x8000:
+        raw -= 0x10000
+
+    if decimals:
+        return raw / 10**decimals
+    return raw
+
+
+def encode_register(value, decimals=0, signed=False):
+    raw = int(round(value * 10**decimals))
+    if signed and raw < 0:
+        raw += 0x10000
+    if not 0 <= raw <= 0xFFFF:
+        raise ValueError(f"Value {value} does not fit in a register.")
+    return raw
+
+
+@dataclass(frozen=True)
+class FloatRegister:
+    name: str
+    address: int
+    unit: str
+    stream: str
+    decimals: int = 0
+    signed: bool = False
+    limits: tuple = None
+    poll: tuple = POLL_DEFAULT
+    tolerance: float = 0
+    transient: bool = False
+    ttl: float = 1
+    heartbeat: float = HEARTBEAT_DEFAULT
+
+    kind = 'float'
+    data_type = EcodanFloatData
+
+    @property
+    def addresses(self):
+        return (self.address,)
+
+    @staticmethod
+    def value_of(data):
+        return data.value
+
+    def compile(self):
+        address, decimals, signed, unit = self.address, self.decimals, self.signed, self.unit
+
+        def decode(registers):
+            return EcodanFloatData(decode_register(registers[address], decimals, signed), unit)
+
+        return decode
+
+    def validate(self, value):
+        if self.limits is None:
+            raise ValueError(f"Register {self.name} is read-only.")
+
+        if type(value) not in (int, float):
+            raise TypeError("Value must be numeric.")
+
+        low, high = self.limits
+        if value < low or value > high:
+            raise ValueError(f"Value must be between {low} and {high} (inclusive).")
+
+
+@dataclass(frozen=True)
+class LutRegister:
+    name: str
+    address: int
+    lut: dict
+    stream: str
+    poll: tuple = POLL_DEFAULT
+    tolerance: float = 0
+    transient: bool = False
+    ttl: float = 10
+    heartbeat: float = HEARTBEAT_DEFAULT
+
+    kind = 'lut'
+    data_type = EcodanLutData
+
+    @property
+    def addresses(self):
+        return (self.address,)
+
+    @staticmethod
+    def value_of(data):
+        return data.code
+
+    def compile(self):
+        address, lut = self.address, self.lut
+
+        def decode(registers):
+            code = registers[address]
+            return EcodanLutData(code, lut.get(code, 'Unknown'))
+
+        return decode
+
+
+@dataclass(frozen=True)
+class EnergyRegister:
+    name: str
+    kwh_address: int
+    wh_address: int
+    date_address: int
+    stream: str
+    unit: str = 'kWh'
+    poll: tuple = POLL_DEFAULT
+    tolerance: float = 0
+    transient: bool = False
+    ttl: float = 60
+
+    kind = 'energy'
+    data_type = EcodanEnergyData
+
+    @property
+    def addresses(self):
+        return (self.kwh_address, self.wh_address,
+                self.date_address, self.date_address + 1, self.date_address + 2)
+
+    @staticmethod
+    def value_of(data):
+        return data.value
+
+    def compile(self):
+        kwh_address, wh_address, date_address, unit = \
+            self.kwh_address, self.wh_address, self.date_address, self.unit
+
+        def decode(registers):
+            value = registers[kwh_address] + (registers[wh_address] * 10 / 1000)
+            date = datetime.date(
+                2000 + registers[date_address],
+                registers[date_address + 1],
+                registers[date_address + 2])
+            return EcodanEnergyData(value, unit, date)
+
+        return decode
+
+
+OPERATING_MODES = {
+    0: 'Stop',
+    1: 'Hot water',
+    2: 'Heating',
+    3: 'Cooling',
+    4: 'No voltage contact input (hot water storage)',
+    5: 'Freeze stat',
+    6: 'Legionella',
+    7: 'Heating eco',
+    8: 'Mode 1',
+    9: 'Mode 2',
+    10: 'Mode 3',
+    11: 'No voltage contact input (heating up)'
+}
+
+HEAT_SOURCES = {
+    0: 'Heatpump',
+    1: 'Immersion heater',
+    2: 'Backup heater',
+    3: 'Immersion and backup heater',
+    4: 'Boiler'
+}
+
+DEFROST_STATUSES = {
+    0: 'Normal',
+    1: 'Standby',
+    2: 'Defrost',
+    3: 'Waiting restart'
+}
+
+DHW_STATUSES = {
+    0: 'Enabled',
+    1: 'Disabled'
+}
+
+REGISTERS = (
+    FloatRegister('tank_temp', 106, '°C', 'tank_temp', decimals=2,
+                  poll=(10, 120), tolerance=0.2, transient=True),
+    FloatRegister('tank_target_temp', 31, '°C', 'tank_set_temp', decimals=2, limits=(10, 60),
+                  poll=(30, 600), ttl=30, heartbeat=3600),
+    FloatRegister('house_temp', 94, '°C', 'house_temp', decimals=2,
+                  poll=(30, 300), tolerance=0.1),
+    FloatRegister('house_target_temp', 55, '°C', 'house_set_temp', decimals=2, limits=(5, 25),
+                  poll=(30, 600), ttl=30, heartbeat=3600),
+    FloatRegister('outdoor_temp', 99, '°C', 'outdoor_temp', decimals=1, signed=True,
+                  poll=(60, 600), tolerance=0.5, ttl=30),
+    FloatRegister('pump_freq', 73, 'Hz', 'pump_freq',
+                  poll=(10, 120), tolerance=1, transient=True),
+    FloatRegister('flow', 299, 'l/min', 'flow',
+                  poll=(10, 120), tolerance=1, transient=True),
+    FloatRegister('pump_supply_temp', 102, '°C', 't_flow', decimals=2,
+                  poll=(10, 120), tolerance=0.2, transient=True),
+    FloatRegister('pump_return_temp', 104, '°C', 't_return', decimals=2,
+                  poll=(10, 120), tolerance=0.2, transient=True),
+    EnergyRegister('energy_consumed_tank', 286, 287, 279, 'nrg_cons_tank', poll=(60, 600)),
+    EnergyRegister('energy_produced_tank', 296, 297, 289, 'nrg_prod_tank', poll=(60, 600)),
+    EnergyRegister('energy_consumed_house', 282, 283, 279, 'nrg_cons_house', poll=(60, 600)),
+    EnergyRegister('energy_produced_house', 292, 293, 289, 'nrg_prod_house', poll=(60, 600)),
+    LutRegister('operating_mode', 26, OPERATING_MODES, 'operating_mode', poll=(10, 60)),
+    LutRegister('heat_source', 80, HEAT_SOURCES, 'heat_source', poll=(30, 300), heartbeat=3600),
+    LutRegister('defrost_status', 67, DEFROST_STATUSES, 'defrost_status', poll=(10, 60)),
+    LutRegister('dhw_enabled', 39, DHW_STATUSES, 'dhw_enabled', poll=(60, 600), ttl=60, heartbeat=3600),
+)
+
+
+class RegisterSchema:
+    def __init__(self, registers):
+        self.registers = tuple(registers)
+        self.by_name = {r.name: r for r in self.registers}
+        self.by_kind = {
+            kind: tuple(r for r in self.registers if r.kind == kind)
+            for kind in ('float', 'lut', 'energy')
+        }
+
+        self.decoders = tuple((r.name, r.compile()) for r in self.registers)
+        self.decoder_by_name = dict(self.decoders)
+        self.read_plan = self.plan(self.registers)
+        self.read_plans = {}
+
+    def __getitem__(self, name):
+        return self.by_name[name]
+
+    def plan(self, registers):
+        return plan_reads(a for r in registers for a in r.addresses)
+
+    def plan_for(self, names):
+        key = frozenset(names)
+        plan = self.read_plans.get(key)
+        if plan is None:
+            plan = self.read_plans[key] = self.plan(self.by_name[name] for name in key)
+        return plan
+
+    def decode(self, registers, names=None):
+        if names is None:
+            return {name: decode(registers) for name, decode in self.decoders}
+        return {name: self.decoder_by_name[name](registers) for name in names}
+
+    def read_times(self, timestamps, names):
+        # A value spread over several registers is as recent as its oldest one.
+        return {name: min(timestamps[a] for a in self.by_name[name].addresses) for name in names}
+
+    def decode_partial(self, registers, names):
+        values = {}
+        missing = []
+        for name in names:
+            if all(a in registers for a in self.by_name[name].addresses):
+                values[name] = self.decoder_by_name[name](registers)
+            else:
+                missing.append(name)
+        return values, missing
+
+
+SCHEMA = RegisterSchema(REGISTERS)
@@ -0,0 +1,160 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compact storage for buffered samples. Values are kept column by column in
+# one preallocated array, indexed by a fixed field order; units stay in the
+# register schema. A missing value is NaN.
+
+from array import array
+from bisect import bisect_left
+import math
+
+
+NAN = math.nan
+
+
+class SampleWindow:
+    # Zero-copy view of consecutive samples. Every column is one or two
+    # memoryview segments, two when the window wraps around the ring.
+    def __init__(self, ring, segments):
+        self.ring = ring
+        self.segments = segments
+
+    def __len__(self):
+        return sum(end - start for start, end in self.segments)
+
+    def __view(self, offset):
+        view = self.ring.view
+        return [view[offset + start:offset + end] for start, end in self.segments]
+
+    @property
+    def times(self):
+        view = self.ring.time_view
+        return [view[start:end] for start, end in self.segments]
+
+    def column(self, name):
+        return self.__view(self.ring.index[name] * self.ring.capacity)
+
+    def aggregate(self, name):
+        # (min, max, mean, last, count) of the values present, None if none
+        # are. Works on the segments in place; a segment without missing
+        # values is reduced by the builtins, only one with NaNs is walked.
+        low, high, total, count, last = math.inf, -math.inf, 0.0, 0, None
+        for segment in self.column(name):
+            if not segment:
+                continue
+
+            segment_total = math.fsum(segment)
+            if segment_total == segment_total:
+                low = min(low, min(segment))
+                high = max(high, max(segment))
+                total += segment_total
+                count += len(segment)
+                last = segment[-1]
+                continue
+
+            for value in segment:
+                if value == value:
+                    low = min(low, value)
+                    high = max(high, value)
+                    total += value
+                    count += 1
+                    last = value
+
+        if not count:
+            return None
+        return low, high, total / count, last, count
+
+    def to_dict(self):
+        columns = {'time': [t for segment in self.times for t in segment.tolist()]}
+        for name in self.ring.fields:
+            columns[name] = [None if v != v else v for segment in self.column(name) for v in segment.tolist()]
+        return columns
+
+
+class _LogicalTimes:
+    # Lets bisect search the ring's timestamps in order, oldest first.
+    def __init__(self, ring):
+        self.ring = ring
+
+    def __len__(self):
+        return self.ring.size
+
+    def __getitem__(self, i):
+        ring = self.ring
+        return ring.times[(ring.start + i) % ring.capacity]
+
+
+class SampleRing:
+    def __init__(self, schema, fields, capacity, typecode='d'):
+        self.schema = schema
+        self.fields = tuple(fields)
+        self.index = {name: i for i, name in enumerate(self.fields)}
+        self.value_of = tuple(schema[name].value_of for name in self.fields)
+        self.capacity = capacity
+
+        self.times = array('d', [0.0]) * capacity
+        self.data = array(typecode, [NAN]) * (capacity * len(self.fields))
+        self.time_view = memoryview(self.times)
+        self.view = memoryview(self.data)
+
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def latest_time(self):
+        if not self.size:
+            return None
+        return self.times[(self.start + self.size - 1) % self.capacity]
+
+    def append(self, timestamp, values):
+        # Samples must arrive in time order, late ones are dropped.
+        latest = self.latest_time()
+        if latest is not None and timestamp <= latest:
+            return False
+
+        capacity = self.capacity
+        position = (self.start + self.size) % capacity
+        if self.size == capacity:
+            self.start = (self.start + 1) % capacity
+        else:
+            self.size += 1
+
+        self.times[position] = timestamp
+        data = self.data
+        for i, name in enumerate(self.fields):
+            value = values.get(name)
+            data[i * capacity + position] = NAN if value is None else self.value_of[i](value)
+        return True
+
+    def window(self, start=None, end=None):
+        # Samples with start <= time < end.
+        times = _LogicalTimes(self)
+        low = 0 if start is None else bisect_left(times, start)
+        high = self.size if end is None else bisect_left(times, end)
+
+        segments = []
+        if low < high:
+            first = (self.start + low) % self.capacity
+            last = first + high - low
+            if last <= self.capacity:
+                segments.append((first, last))
+            else:
+                segments.append((first, self.capacity))
+                segments.append((0, last - self.capacity))
+        return SampleWindow(self, segments)
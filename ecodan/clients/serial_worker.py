@@ -0,0 +1,97 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import itertools
+
+# Lower values are served first. Writes come from users waiting on an API
+# response and jump ahead of queued poll reads at the next transaction.
+PRIORITY_WRITE = 0
+PRIORITY_READ = 10
+
+
+class SerialWorker:
+    def __init__(self, name='serial'):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self.queue = asyncio.PriorityQueue()
+        self.sequence = itertools.count()
+        self.task = None
+
+        # Round-robin between sources (devices) sharing this port: each
+        # request of a source gets the next round number of that source, but
+        # never one older than the round currently being served.
+        self.rounds = {}
+        self.current_round = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_event_loop().create_task(self.__run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, fn, *args, priority=PRIORITY_READ, source=None,
+                     retries=0, backoff=0, retry_on=(), **kwargs):
+        call = functools.partial(fn, *args, **kwargs)
+
+        # A failed call goes back into the queue after the backoff, so other
+        # requests are served in the meantime.
+        for attempt in range(retries + 1):
+            try:
+                return await self.__enqueue(call, priority, source)
+            except retry_on:
+                if attempt == retries:
+                    raise
+                await asyncio.sleep(backoff * 2**attempt)
+
+    async def __enqueue(self, call, priority, source):
+        round_ = max(self.rounds.get(source, 0), self.current_round)
+        self.rounds[source] = round_ + 1
+
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((priority, round_, next(self.sequence), future, call))
+        return await future
+
+    async def __run(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            _, self.current_round, _, future, call = await self.queue.get()
+            try:
+                if future.cancelled():
+                    continue
+
+                try:
+                    result = await loop.run_in_executor(self.executor, call)
+                except Exception as e:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                else:
+                    if not future.cancelled():
+                        future.set_result(result)
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,213 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from contextlib import contextmanager
+import itertools
+import queue
+import socket
+import struct
+import threading
+from urllib.parse import urlsplit, parse_qs
+
+import minimalmodbus
+
+from clients.registers import MAX_READ_COUNT, encode_register
+
+
+READ_HOLDING_REGISTERS = 3
+WRITE_MULTIPLE_REGISTERS = 16
+
+MBAP_HEADER = struct.Struct('>HHHB')
+
+
+# Time the slave gets to start answering, on top of the time the longest
+# possible response spends on the wire.
+RTU_RESPONSE_MARGIN = 0.1
+
+
+def rtu_frame_time(size, baudrate):
+    # A character is 11 bits: start, 8 data, parity or second stop, stop.
+    return size * 11 / baudrate
+
+
+class RtuTransport(minimalmodbus.Instrument):
+    pipelined = False
+
+    def __init__(self, port, slave=1, baudrate=9600, timeout=0.5, *args, **kwargs):
+        super().__init__(port, slave, *args, **kwargs)
+        self.serial.baudrate = baudrate
+        # A read response is address, function, byte count, data and CRC.
+        self.serial.timeout = max(
+            timeout, rtu_frame_time(5 + 2 * MAX_READ_COUNT, baudrate) + RTU_RESPONSE_MARGIN)
+
+    def read_registers_many(self, blocks):
+        return [self.read_registers(start, count) for start, count in blocks]
+
+
+class TcpConnection:
+    def __init__(self, host, port, timeout):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.transaction_ids = itertools.count(1)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def __recv_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise minimalmodbus.NoResponseError('Connection closed by Modbus TCP gateway')
+            data.extend(chunk)
+        return bytes(data)
+
+    def request(self, unit, pdus):
+        # All requests are sent before the first response is read, so a gateway
+        # that queues requests serves them back to back.
+        transaction_ids = []
+        frames = []
+        for pdu in pdus:
+            transaction_id = next(self.transaction_ids) & 0xFFFF
+            transaction_ids.append(transaction_id)
+            frames.append(MBAP_HEADER.pack(transaction_id, 0, len(pdu) + 1, unit) + pdu)
+
+        try:
+            self.sock.sendall(b''.join(frames))
+
+            responses = {}
+            while len(responses) < len(pdus):
+                transaction_id, _, length, _ = MBAP_HEADER.unpack(self.__recv_exactly(MBAP_HEADER.size))
+                responses[transaction_id] = self.__recv_exactly(length - 1)
+        except socket.timeout as e:
+            raise minimalmodbus.NoResponseError(f'No response from Modbus TCP gateway: {e}')
+
+        return [responses[transaction_id] for transaction_id in transaction_ids]
+
+
+class TcpConnectionPool:
+    def __init__(self, host, port, size=2, timeout=3):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        with self.slots:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = TcpConnection(self.host, self.port, self.timeout)
+
+            try:
+                yield conn
+            except Exception:
+                # The stream may be out of sync, never reuse this connection.
+                conn.close()
+                raise
+            else:
+                self.idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host, port, size, timeout):
+    with _pools_lock:
+        pool = _pools.get((host, port))
+        if pool is None:
+            pool = _pools[(host, port)] = TcpConnectionPool(host, port, size, timeout)
+        return pool
+
+
+def check_response(pdu, function_code):
+    if pdu[0] == function_code | 0x80:
+        raise minimalmodbus.SlaveReportedException(
+            f'Modbus exception code {pdu[1]} for function code {function_code}')
+    if pdu[0] != function_code:
+        raise minimalmodbus.InvalidResponseError(
+            f'Unexpected function code {pdu[0]} in response to {function_code}')
+
+
+class TcpTransport:
+    def __init__(self, host, port=502, slave=1, pool_size=2, timeout=3, pipelined=False):
+        self.slave = slave
+        self.pipelined = pipelined
+        self.pool = get_pool(host, port, pool_size, timeout)
+
+    def __request(self, pdus):
+        try:
+            with self.pool.connection() as conn:
+                return conn.request(self.slave, pdus)
+        except (OSError, minimalmodbus.NoResponseError):
+            # Gateways drop idle connections, retry once on a fresh one.
+            with self.pool.connection() as conn:
+                return conn.request(self.slave, pdus)
+
+    def read_registers_many(self, blocks):
+        pdus = [struct.pack('>BHH', READ_HOLDING_REGISTERS, start, count) for start, count in blocks]
+
+        if self.pipelined:
+            responses = self.__request(pdus)
+        else:
+            responses = [self.__request([pdu])[0] for pdu in pdus]
+
+        results = []
+        for (start, count), response in zip(blocks, responses):
+            check_response(response, READ_HOLDING_REGISTERS)
+            if response[1] != 2 * count:
+                raise minimalmodbus.InvalidResponseError(
+                    f'Expected {2 * count} data bytes, got {response[1]}')
+            results.append(list(struct.unpack(f'>{count}H', response[2:2 + 2 * count])))
+        return results
+
+    def read_registers(self, registeraddress, number_of_registers, functioncode=3):
+        return self.read_registers_many([(registeraddress, number_of_registers)])[0]
+
+    def write_register(self, registeraddress, value, number_of_decimals=0, functioncode=16, signed=False):
+        raw = encode_register(value, number_of_decimals, signed)
+        pdu = struct.pack('>BHHBH', WRITE_MULTIPLE_REGISTERS, registeraddress, 1, 2, raw)
+        check_response(self.__request([pdu])[0], WRITE_MULTIPLE_REGISTERS)
+
+
+def create_transport(port, slave=1, baudrate=9600, pool_size=2, timeout=3, serial_timeout=0.5):
+    # Serial ports are given as a device path, TCP gateways as
+    # tcp://host[:port][?pipeline=1].
+    if port.startswith('tcp://'):
+        url = urlsplit(port)
+        options = parse_qs(url.query)
+        return TcpTransport(
+            url.hostname, url.port or 502, slave,
+            pool_size=pool_size,
+            timeout=timeout,
+            pipelined=options.get('pipeline', ['0'])[0] == '1'
+        )
+
+    return RtuTransport(port, slave, baudrate, timeout=serial_timeout)
@@ -26,18 +26,89 @@ def read_secret(variable_name):
     return secret
 
 
+def parse_devices(spec, default_id, default_port, default_slave, default_baudrate):
+    # MODBUS_DEVICES=id@port:slave[:baudrate],... e.g.
+    # MODBUS_DEVICES=ecodan2@/dev/ttyUSB0:1,ecodan3@/dev/ttyUSB0:2,garage@/dev/ttyUSB1:1:19200
+    # Modbus TCP gateways use id@tcp://host[:port][?pipeline=1]:slave
+    if not spec:
+        return [{
+            'id': default_id,
+            'port': default_port,
+            'slave': default_slave,
+            'baudrate': default_baudrate
+        }]
+
+    devices = []
+    baudrates = {}
+    for item in spec.split(','):
+        device_id, address = item.strip().split('@', 1)
+        if address.startswith('tcp://'):
+            port, slave = address.rsplit(':', 1)
+            baudrate = []
+        else:
+            port, slave, *baudrate = address.split(':')
+        baudrate = int(baudrate[0]) if baudrate else default_baudrate
+
+        # Devices on one serial port share its settings.
+        if not port.startswith('tcp://') and baudrates.setdefault(port, baudrate) != baudrate:
+            raise ValueError(f'Conflicting baud rates {baudrates[port]} and {baudrate} for {port}')
+
+        devices.append({
+            'id': device_id,
+            'port': port,
+            'slave': int(slave),
+            'baudrate': baudrate
+        })
+    return devices
+
+
 class Config:
     QUART_AUTH_MODE = 'bearer'
     QUART_AUTH_BASIC_USERNAME = 'admin'
     QUART_AUTH_BASIC_PASSWORD = read_secret('API_ADMIN_PASS')
 
     ECODAN_SERIAL_PORT = os.environ.get('MODBUS_PORT')
-    ECODAN_SERIAL_BAUDRATE = int(os.environ.get('MODBUS_BAUD_RATE'))
-    ECODAN_SLAVE_ADDRESS = int(os.environ.get('MODBUS_SLAVE_ADDR'))
+    ECODAN_SERIAL_BAUDRATE = int(os.environ.get('MODBUS_BAUD_RATE', 9600))
+    ECODAN_SLAVE_ADDRESS = int(os.environ.get('MODBUS_SLAVE_ADDR', 1))
+    ECODAN_SERIAL_TIMEOUT = float(os.environ.get('MODBUS_TIMEOUT', 0.5))
+    ECODAN_DEVICES = parse_devices(
+        os.environ.get('MODBUS_DEVICES'),
+        default_id=os.environ.get('MODBUS_DEVICE_ID', 'ecodan2'),
+        default_port=ECODAN_SERIAL_PORT,
+        default_slave=ECODAN_SLAVE_ADDRESS,
+        default_baudrate=ECODAN_SERIAL_BAUDRATE
+    )
+    ECODAN_TCP_POOL_SIZE = int(os.environ.get('MODBUS_TCP_POOL_SIZE', 2))
+    ECODAN_TCP_TIMEOUT = float(os.environ.get('MODBUS_TCP_TIMEOUT', 3))
+    ECODAN_RETRIES = int(os.environ.get('MODBUS_RETRIES', 2))
+    ECODAN_RETRY_BACKOFF = float(os.environ.get('MODBUS_RETRY_BACKOFF', 0.5))
+    ECODAN_BREAKER_THRESHOLD = int(os.environ.get('MODBUS_BREAKER_THRESHOLD', 3))
+    ECODAN_BREAKER_TIMEOUT = int(os.environ.get('MODBUS_BREAKER_TIMEOUT', 60))
+    ECODAN_BREAKER_MAX_TIMEOUT = int(os.environ.get('MODBUS_BREAKER_MAX_TIMEOUT', 900))
+    ECODAN_POLL_INTERVAL = int(os.environ.get('MODBUS_POLL_INTERVAL', 10))
+    ECODAN_POLL_MAX_INSTANCES = int(os.environ.get('MODBUS_POLL_MAX_INSTANCES', 1))
+    ECODAN_POLL_ADAPTIVE = os.environ.get('MODBUS_POLL_ADAPTIVE', '1') == '1'
+    ECODAN_HF_INTERVAL = int(os.environ.get('MODBUS_HF_INTERVAL', 2))
+    ECODAN_HF_WINDOW = int(os.environ.get('MODBUS_HF_WINDOW', 60))
+    ECODAN_HF_RAW_TRIGGER = os.environ.get('MODBUS_HF_RAW_TRIGGER', 'defrost')
+    ECODAN_HF_BUFFER = int(os.environ.get('MODBUS_HF_BUFFER', 100000))
+    ECODAN_STREAM_BUFFER = int(os.environ.get('API_STREAM_BUFFER', 16))
 
     INFLUX_HOST = os.environ.get('INFLUX_HOST')
     INFLUX_DATABASE = os.environ.get('INFLUX_DATABASE')
     INFLUX_USERNAME = os.environ.get('INFLUX_USERNAME')
     INFLUX_PASSWORD = read_secret('INFLUX_PASSWORD')
+    INFLUX_STREAM_PREFIX = os.environ.get('INFLUX_STREAM_PREFIX', 'ecodan2_')
+    INFLUX_DEADBAND = os.environ.get('INFLUX_DEADBAND', '1') == '1'
+    INFLUX_TIMEOUT = int(os.environ.get('INFLUX_TIMEOUT', 10))
+    INFLUX_BATCH_SIZE = int(os.environ.get('INFLUX_BATCH_SIZE', 500))
+    INFLUX_FLUSH_INTERVAL = int(os.environ.get('INFLUX_FLUSH_INTERVAL', 10))
+    INFLUX_RETRY_INTERVAL = int(os.environ.get('INFLUX_RETRY_INTERVAL', 60))
+
+    HISTORY_RAW_RETENTION = int(os.environ.get('HISTORY_RAW_RETENTION', 6))
+    HISTORY_MINUTE_RETENTION = int(os.environ.get('HISTORY_MINUTE_RETENTION', 7))
+    HISTORY_HOUR_RETENTION = int(os.environ.get('HISTORY_HOUR_RETENTION', 365))
+    HISTORY_FLUSH_INTERVAL = int(os.environ.get('HISTORY_FLUSH_INTERVAL', 60))
 
     DATABASE_PATH = os.environ.get('SQLITE_DB_PATH')
+    DATABASE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', 2))
@@ -1,3 +1,5 @@
+import asyncio
+from contextlib import asynccontextmanager
 import glob
 import importlib.util
 import os
@@ -8,6 +10,15 @@ import sqlite3
 import aiosqlite
 
 
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -8000',
+)
+
+
 class Database:
     def __init__(self, app):
         self.app = app
@@ -15,36 +26,72 @@ class Database:
         Model.db = self
 
         self.db_path = self.app.config['DATABASE_PATH']
+        self.pool_size = self.app.config['DATABASE_POOL_SIZE']
+
+        self.pool = None
+        self.connections = []
+
+    async def open(self):
+        if self.pool is not None:
+            return
+
+        self.pool = asyncio.Queue()
+        for _ in range(self.pool_size):
+            conn = await aiosqlite.connect(self.db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+            for pragma in PRAGMAS:
+                await conn.execute(pragma)
+
+            self.connections.append(conn)
+            self.pool.put_nowait(conn)
+
+    async def close(self):
+        for conn in self.connections:
+            await conn.close()
+
+        self.connections = []
+        self.pool = None
 
-    def connect(self):
-        return aiosqlite.connect(self.db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+    @asynccontextmanager
+    async def connect(self):
+        if self.pool is None:
+            await self.open()
+
+        conn = await self.pool.get()
+        try:
+            yield conn
+        finally:
+            # Never hand out a connection with somebody else's open transaction.
+            if conn.in_transaction:
+                await conn.rollback()
+            self.pool.put_nowait(conn)
 
     async def migrate(self):
         async with self.connect() as conn:
+            await conn.execute("BEGIN")
             await conn.execute("""
                 CREATE TABLE IF NOT EXISTS migrations (
                         name primary key
                 );
             """)
-            await conn.commit()
 
-        migrations_dir = os.path.join(os.path.dirname(__file__), 'migrations')
-        for m in glob.glob(f'{migrations_dir}/*.py'):
-            name = Path(m).name
-
-            async with self.connect() as conn:
-                async with conn.execute("SELECT count() FROM migrations WHERE name = :name",
-                                        {'name': name}) as curs:
-                    if (await curs.fetchone())[0] < 1:
-                        spec = importlib.util.spec_from_file_location("ecodan.db.migration", m)
-                        mod = importlib.util.module_from_spec(spec)
-                        sys.modules["ecodan.db.migration"] = mod
-                        spec.loader.exec_module(mod)
-
-                        async with self.connect() as conn:
-                            await mod.migrate(conn)
-                            await conn.execute("INSERT INTO migrations VALUES (:name)", {'name': name})
-                            await conn.commit()
+            async with conn.execute("SELECT name FROM migrations") as curs:
+                applied = {row[0] for row in await curs.fetchall()}
+
+            migrations_dir = os.path.join(os.path.dirname(__file__), 'migrations')
+            for m in sorted(glob.glob(f'{migrations_dir}/*.py')):
+                name = Path(m).name
+                if name in applied:
+                    continue
+
+                spec = importlib.util.spec_from_file_location("ecodan.db.migration", m)
+                mod = importlib.util.module_from_spec(spec)
+                sys.modules["ecodan.db.migration"] = mod
+                spec.loader.exec_module(mod)
+
+                await mod.migrate(conn)
+                await conn.execute("INSERT INTO migrations VALUES (:name)", {'name': name})
+
+            await conn.commit()
 
 
 class Model:
@@ -0,0 +1,43 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+async def migrate(connection):
+    await connection.execute("""
+        CREATE TABLE history_raw (
+            device text,
+            name text,
+            time real,
+            value real,
+            PRIMARY KEY (device, name, time)
+        ) WITHOUT ROWID;
+    """)
+    await connection.execute("CREATE INDEX history_raw_time ON history_raw (time);")
+
+    for table in ('history_1m', 'history_1h'):
+        await connection.execute(f"""
+            CREATE TABLE {table} (
+                device text,
+                name text,
+                bucket integer,
+                min real,
+                max real,
+                sum real,
+                count integer,
+                last real,
+                PRIMARY KEY (device, name, bucket)
+            ) WITHOUT ROWID;
+        """)
+        await connection.execute(f"CREATE INDEX {table}_bucket ON {table} (bucket);")
@@ -14,49 +14,122 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import datetime
+
 from db.base import Model
 
 
+# Number of consecutive samples with an implausible device date it takes to
+# believe the device clock was really changed.
+CLOCK_CHANGE_SAMPLES = 3
+
+# How far the device date may run ahead of the host date, for time zones.
+CLOCK_AHEAD = datetime.timedelta(days=1)
+ONE_DAY = datetime.timedelta(days=1)
+
+
 class EnergyInfluxState(Model):
-    def __init__(self, stream, last_date, last_value):
+    UPSERT = """INSERT INTO energy_influx_state VALUES (:stream, :last_date, :last_value, :total)
+        ON CONFLICT (stream) DO UPDATE SET
+            last_date = excluded.last_date,
+            last_value = excluded.last_value,
+            total = excluded.total
+        """
+
+    def __init__(self, stream, last_date, last_value, total=None):
         self.stream = stream
         self.last_date = last_date
         self.last_value = last_value
+        self.total = last_value if total is None else total
+        self.implausible_samples = 0
 
     @staticmethod
-    async def from_stream(stream):
+    async def all():
         async with Model.db.connect() as conn:
-            async with conn.execute(
-                    'SELECT * FROM energy_influx_state WHERE stream = ?', (stream,)) as curs:
-                result = await curs.fetchone()
-                if result:
-                    return EnergyInfluxState(*result)
+            async with conn.execute('SELECT * FROM energy_influx_state') as curs:
+                return [EnergyInfluxState(*result) for result in await curs.fetchall()]
+
+    @staticmethod
+    async def assign_device(device):
+        # Rows stored before state was kept per device belong to the single
+        # device setup.
+        async with Model.db.connect() as conn:
+            await conn.execute(
+                "UPDATE energy_influx_state SET stream = ? || ':' || stream WHERE instr(stream, ':') = 0",
+                (device,))
+            await conn.commit()
+
+    @staticmethod
+    async def save_many(conn, states):
+        # Part of the caller's transaction, the caller commits.
+        await conn.executemany(EnergyInfluxState.UPSERT, [s.data() for s in states])
 
     def data(self):
         return {
             'stream': self.stream,
             'last_date': self.last_date,
-            'last_value': self.last_value
+            'last_value': self.last_value,
+            'total': self.total
         }
 
-    async def save(self):
-        async with self.db.connect() as conn:
-            await conn.execute(
-                """INSERT INTO energy_influx_state VALUES (:stream, :last_date, :last_value)
-                ON CONFLICT (stream) DO UPDATE SET
-                    last_date = excluded.last_date,
-                    last_value = excluded.last_value
-                """, self.data())
-            await conn.commit()
-
-    async def update_from_ecodan(self, ecodan_data):
-        if ecodan_data.date < self.last_date:
-            return False
+    def apply(self, ecodan_data, today=None):
+        # Turns the daily counter into the energy added since the previous
+        # sample, or None when the sample adds nothing.
+        today = datetime.date.today() if today is None else today
 
-        if ecodan_data.date == self.last_date and ecodan_data.value <= self.last_value:
-            return False
+        date = ecodan_data.date
+        # Midnight moves the date one day on. An earlier date, or a jump past
+        # the host date, is a bad read unless it persists: then the device
+        # clock was changed and counting continues from here.
+        if date < self.last_date or (date > self.last_date + ONE_DAY and date > today + CLOCK_AHEAD):
+            self.implausible_samples += 1
+            if self.implausible_samples < CLOCK_CHANGE_SAMPLES:
+                return None
+            delta = 0
+        elif date == self.last_date:
+            self.implausible_samples = 0
+            delta = ecodan_data.value - self.last_value
+            if delta <= 0:
+                # Within a day the counter only goes back on a bad read.
+                return None
+        else:
+            # The counter restarted from zero at the device's midnight.
+            delta = ecodan_data.value
 
-        self.last_date = ecodan_data.date
+        self.implausible_samples = 0
+        self.last_date = date
         self.last_value = ecodan_data.value
-        await self.save()
-        return True
+        self.total += delta
+        return delta
+
+
+class EnergyInfluxStateCache:
+    def __init__(self, device):
+        self.device = device
+        self.states = None
+        self.dirty = {}
+
+    async def load(self):
+        await EnergyInfluxState.assign_device(self.device)
+        self.states = {state.stream: state for state in await EnergyInfluxState.all()}
+
+    async def update_from_ecodan(self, stream, ecodan_data):
+        if self.states is None:
+            await self.load()
+
+        state = self.states.get(stream)
+        if state is None:
+            state = EnergyInfluxState(stream, ecodan_data.date, ecodan_data.value)
+            self.states[stream] = state
+            delta = 0
+        else:
+            delta = state.apply(ecodan_data)
+
+        if delta is not None:
+            self.dirty[stream] = state
+        return delta
+
+    async def write(self, conn):
+        if self.dirty:
+            states, self.dirty = list(self.dirty.values()), {}
+            await EnergyInfluxState.save_many(conn, states)
@@ -0,0 +1,70 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from db.base import Model
+
+
+# Rollup tables by their bucket size in seconds.
+ROLLUPS = {
+    60: 'history_1m',
+    3600: 'history_1h'
+}
+
+
+class History(Model):
+    ROLLUP_UPSERT = """INSERT INTO {table} VALUES (:device, :name, :bucket, :min, :max, :sum, :count, :last)
+        ON CONFLICT (device, name, bucket) DO UPDATE SET
+            min = min({table}.min, excluded.min),
+            max = max({table}.max, excluded.max),
+            sum = {table}.sum + excluded.sum,
+            count = {table}.count + excluded.count,
+            last = excluded.last
+        """
+
+    @staticmethod
+    async def save(raw, rollups):
+        # raw: (device, name, time, value) rows, rollups: rows per bucket size.
+        async with Model.db.connect() as conn:
+            await conn.executemany('INSERT OR REPLACE INTO history_raw VALUES (?, ?, ?, ?)', raw)
+            for size, rows in rollups.items():
+                await conn.executemany(History.ROLLUP_UPSERT.format(table=ROLLUPS[size]), rows)
+            await conn.commit()
+
+    @staticmethod
+    async def prune(raw_before, rollups_before):
+        async with Model.db.connect() as conn:
+            await conn.execute('DELETE FROM history_raw WHERE time < ?', (raw_before,))
+            for size, before in rollups_before.items():
+                await conn.execute(f'DELETE FROM {ROLLUPS[size]} WHERE bucket < ?', (before,))
+            await conn.commit()
+
+    @staticmethod
+    async def raw(device, name, start, end):
+        async with Model.db.connect() as conn:
+            async with conn.execute(
+                    'SELECT time, value FROM history_raw '
+                    'WHERE device = ? AND name = ? AND time >= ? AND time < ? ORDER BY time',
+                    (device, name, start, end)) as curs:
+                return await curs.fetchall()
+
+    @staticmethod
+    async def rollup(size, device, name, start, end):
+        async with Model.db.connect() as conn:
+            async with conn.execute(
+                    f'SELECT bucket, min, max, sum / count, last, count FROM {ROLLUPS[size]} '
+                    'WHERE device = ? AND name = ? AND bucket >= ? AND bucket < ? ORDER BY bucket',
+                    (device, name, start - start % size, end)) as curs:
+                return await curs.fetchall()
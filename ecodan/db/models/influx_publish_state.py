@@ -0,0 +1,85 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from db.base import Model
+
+
+class InfluxPublishState(Model):
+    UPSERT = """INSERT INTO influx_publish_state VALUES (:stream, :last_time, :last_value)
+        ON CONFLICT (stream) DO UPDATE SET
+            last_time = excluded.last_time,
+            last_value = excluded.last_value
+        """
+
+    def __init__(self, stream, last_time, last_value):
+        self.stream = stream
+        self.last_time = last_time
+        self.last_value = last_value
+
+    @staticmethod
+    async def all():
+        async with Model.db.connect() as conn:
+            async with conn.execute('SELECT * FROM influx_publish_state') as curs:
+                return [InfluxPublishState(*result) for result in await curs.fetchall()]
+
+    @staticmethod
+    async def save_many(conn, states):
+        # Part of the caller's transaction, the caller commits.
+        await conn.executemany(InfluxPublishState.UPSERT, [s.data() for s in states])
+
+    def data(self):
+        return {
+            'stream': self.stream,
+            'last_time': self.last_time,
+            'last_value': self.last_value
+        }
+
+    def apply(self, value, timestamp, tolerance, heartbeat):
+        # A clock that went backwards counts as an expired heartbeat.
+        elapsed = timestamp - self.last_time
+        if abs(value - self.last_value) <= tolerance and 0 <= elapsed < heartbeat:
+            return False
+
+        self.last_time = timestamp
+        self.last_value = value
+        return True
+
+
+class InfluxPublishStateCache:
+    def __init__(self):
+        self.states = None
+        self.dirty = {}
+
+    async def load(self):
+        self.states = {state.stream: state for state in await InfluxPublishState.all()}
+
+    async def publish(self, stream, value, timestamp, tolerance, heartbeat):
+        if self.states is None:
+            await self.load()
+
+        state = self.states.get(stream)
+        if state is None:
+            state = self.states[stream] = InfluxPublishState(stream, timestamp, value)
+        elif not state.apply(value, timestamp, tolerance, heartbeat):
+            return False
+
+        self.dirty[stream] = state
+        return True
+
+    async def write(self, conn):
+        if self.dirty:
+            states, self.dirty = list(self.dirty.values()), {}
+            await InfluxPublishState.save_many(conn, states)
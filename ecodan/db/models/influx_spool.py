@@ -0,0 +1,44 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from db.base import Model
+
+
+class InfluxSpool(Model):
+    # Points are spooled in line protocol, as the writer sends them.
+    def __init__(self, id, payload):
+        self.id = id
+        self.payload = payload
+
+    @staticmethod
+    async def push(points):
+        async with Model.db.connect() as conn:
+            await conn.executemany(
+                'INSERT INTO influx_spool (payload) VALUES (?)', [(p,) for p in points])
+            await conn.commit()
+
+    @staticmethod
+    async def peek(limit):
+        async with Model.db.connect() as conn:
+            async with conn.execute(
+                    'SELECT * FROM influx_spool ORDER BY id LIMIT ?', (limit,)) as curs:
+                return [InfluxSpool(*row) for row in await curs.fetchall()]
+
+    @staticmethod
+    async def delete_until(last_id):
+        async with Model.db.connect() as conn:
+            await conn.execute('DELETE FROM influx_spool WHERE id <= ?', (last_id,))
+            await conn.commit()
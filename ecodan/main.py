@@ -14,16 +14,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import asyncio
-
 from quart import Quart
 from quart_auth import QuartAuth
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-
 from config import Config
 from db.base import Database
 from services.ecodan import EcodanService
+from services.history import HistoryService
 from services.influx import InfluxService
 
 from blueprints.api import api
@@ -35,6 +32,7 @@ class Services:
         self.app = app
 
         self.influx = InfluxService(self.app)
+        self.history = HistoryService(self.app)
         self.ecodan = EcodanService(self.app)
 
 
@@ -48,13 +46,9 @@ app.auth = QuartAuth(app)
 
 @app.before_serving
 async def startup():
+    await app.db.open()
     await app.db.migrate()
 
-    loop = asyncio.get_event_loop()
-
-    app.scheduler = AsyncIOScheduler(event_loop=loop)
-    app.scheduler.start()
-
     app.services = Services(app)
 
     app.register_blueprint(api, url_prefix='/api')
@@ -63,4 +57,7 @@ async def startup():
 
 @app.after_serving
 async def shutdown():
-    app.scheduler.shutdown()
+    await app.services.ecodan.close()
+    await app.services.history.close()
+    await app.services.influx.close()
+    await app.db.close()
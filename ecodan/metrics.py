@@ -0,0 +1,206 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Minimal Prometheus text exposition. Metrics are updated from the event loop
+# and from the Modbus and Influx worker threads, so every child has a lock.
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import math
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{n}="{escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_number(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+
+    def expose(self):
+        lines = self.header()
+        for values, child in list(self.children.items()):
+            lines.extend(child.expose(self.name, format_labels(self.label_names, values)))
+        return lines
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def expose(self, name, labels):
+        return [f'{name}{labels} {format_number(self.value)}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def new_child(self):
+        return CounterChild()
+
+
+class GaugeChild(CounterChild):
+    def set(self, value):
+        self.value = value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def new_child(self):
+        return GaugeChild()
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def expose(self, name, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+
+        lines = []
+        cumulative = 0
+        inner = labels[1:-1] + ',' if labels else ''
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{inner}le="{format_number(bound)}"}} {cumulative}')
+        lines.append(f'{name}_sum{labels} {format_number(total)}')
+        lines.append(f'{name}_count{labels} {cumulative}')
+        return lines
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(float(b) for b in buckets)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def expose(self, extra=()):
+        lines = []
+        for metric in list(self.metrics) + list(extra):
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+MODBUS_SECONDS = REGISTRY.histogram(
+    'ecodan_modbus_request_seconds', 'Duration of Modbus requests.', ('device', 'operation'))
+MODBUS_TRANSACTIONS = REGISTRY.counter(
+    'ecodan_modbus_transactions_total', 'Modbus transactions sent.', ('device', 'operation'))
+MODBUS_ERRORS = REGISTRY.counter(
+    'ecodan_modbus_errors_total', 'Failed Modbus requests by error kind.', ('device', 'operation', 'kind'))
+
+POLL_SECONDS = REGISTRY.histogram(
+    'ecodan_poll_seconds', 'Duration of a poll cycle, from reading to buffering the points.',
+    ('device', 'job'))
+POLL_REGISTERS = REGISTRY.counter(
+    'ecodan_poll_registers_total', 'Registers read by poll cycles.', ('device',))
+POLL_MISSING = REGISTRY.counter(
+    'ecodan_poll_missing_total', 'Registers missing from a poll after all retries.', ('device', 'register'))
+POLL_SKIPPED = REGISTRY.counter(
+    'ecodan_poll_skipped_total', 'Polls skipped while the circuit breaker is open.', ('device',))
+CIRCUIT_OPEN = REGISTRY.gauge(
+    'ecodan_circuit_breaker_open', 'Whether polling is suspended after repeated bus failures.', ('device',))
+
+SAVE_SECONDS = REGISTRY.histogram(
+    'ecodan_influx_save_seconds', 'Duration of the phases of saving a sample.', ('phase',))
+INFLUX_WRITE_SECONDS = REGISTRY.histogram(
+    'ecodan_influx_write_seconds', 'Duration of Influx write requests.')
+INFLUX_POINTS = REGISTRY.counter(
+    'ecodan_influx_points_total', 'Points by outcome.', ('outcome',))
+
+SCHEDULER_EVENTS = REGISTRY.counter(
+    'ecodan_scheduler_events_total', 'Scheduler job events.', ('job', 'event'))
@@ -0,0 +1,65 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from dataclasses import dataclass
+import datetime
+
+
+@dataclass(slots=True)
+class EcodanAggregateData:
+    min: float
+    max: float
+    mean: float
+    last: float
+    count: int
+    unit: str
+
+
+class WindowAggregator:
+    # Aggregates the samples buffered in a SampleRing per window; the ring
+    # itself keeps them afterwards for export.
+    def __init__(self, samples, window):
+        self.samples = samples
+        self.window = window
+        self.window_start = None
+
+    def add(self, timestamp, values):
+        timestamp = timestamp.timestamp()
+
+        summary = None
+        if self.window_start is None:
+            self.window_start = timestamp
+        elif timestamp - self.window_start >= self.window:
+            summary = self.flush()
+            self.window_start = timestamp
+
+        self.samples.append(timestamp, values)
+        return summary
+
+    def flush(self):
+        if self.window_start is None:
+            return None
+
+        window = self.samples.window(self.window_start)
+        aggregates = {}
+        for name in self.samples.fields:
+            aggregate = window.aggregate(name)
+            if aggregate is not None:
+                aggregates[name] = EcodanAggregateData(
+                    *aggregate, unit=self.samples.schema[name].unit)
+
+        window_start, self.window_start = self.window_start, None
+        return (datetime.datetime.fromtimestamp(window_start), aggregates) if aggregates else None
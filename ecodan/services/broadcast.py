@@ -0,0 +1,58 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+
+
+class Subscription:
+    def __init__(self, buffer_size):
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+        self.dropped = False
+
+    def offer(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # Slow consumer: replace its backlog with an end-of-stream marker
+            # instead of holding up the publisher.
+            self.dropped = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+            return False
+        return True
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class Broadcaster:
+    def __init__(self, buffer_size=16):
+        self.buffer_size = buffer_size
+        self.subscriptions = set()
+
+    def subscribe(self):
+        subscription = Subscription(self.buffer_size)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.discard(subscription)
+
+    def publish(self, message):
+        for subscription in list(self.subscriptions):
+            if not subscription.offer(message):
+                self.subscriptions.discard(subscription)
@@ -0,0 +1,55 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    # Opens after 'threshold' consecutive failed polls. While open, polls are
+    # skipped until the timeout expires, then a single trial poll decides
+    # between closing again and reopening with a doubled timeout.
+    def __init__(self, threshold=3, timeout=60, max_timeout=900):
+        self.threshold = threshold
+        self.base_timeout = timeout
+        self.max_timeout = max_timeout
+
+        self.state = CLOSED
+        self.failures = 0
+        self.timeout = timeout
+        self.retry_at = 0
+
+    def allow(self, now):
+        if self.state == OPEN and now >= self.retry_at:
+            self.state = HALF_OPEN
+        return self.state != OPEN
+
+    def success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.timeout = self.base_timeout
+
+    def failure(self, now):
+        self.failures += 1
+
+        if self.state == HALF_OPEN:
+            self.timeout = min(self.max_timeout, self.timeout * 2)
+        elif self.failures < self.threshold:
+            return
+
+        self.state = OPEN
+        self.retry_at = now + self.timeout
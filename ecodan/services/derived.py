@@ -0,0 +1,173 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import deque
+from dataclasses import dataclass
+import datetime
+
+
+# Specific heat of water in kJ/(kg K); a litre weighs about a kilogram.
+SPECIFIC_HEAT_WATER = 4.2
+
+# Samples further apart than this, in seconds, are not integrated: the bus
+# or the service was down in between.
+MAX_GAP = 900
+
+COP_WINDOW = datetime.timedelta(hours=1)
+COP_MIN_CONSUMED = 0.05  # kWh
+
+DEFROST_STATUS = 2
+DEFROST_COUNT_WINDOW = datetime.timedelta(hours=24)
+
+CONSUMED_ENERGY = ('energy_consumed_house', 'energy_consumed_tank')
+
+
+@dataclass
+class DerivedPoint:
+    stream: str
+    fields: dict
+    unit: str
+    timestamp: datetime.datetime
+
+
+def thermal_power(data):
+    # In W, None when one of the inputs was not read.
+    if data.flow is None or data.pump_supply_temp is None or data.pump_return_temp is None:
+        return None
+    if data.flow.value <= 0:
+        return 0.0
+
+    dt = data.pump_supply_temp.value - data.pump_return_temp.value
+    return dt * data.flow.value / 60 * SPECIFIC_HEAT_WATER * 1000
+
+
+def elapsed(previous, timestamp):
+    # Seconds between two samples, None if they cannot be integrated over.
+    seconds = (timestamp - previous).total_seconds()
+    return seconds if 0 < seconds <= MAX_GAP else None
+
+
+class DerivedMetrics:
+    # Incremental per-device metrics, updated once per sample.
+    def __init__(self):
+        self.power = None
+        self.consumed_at = None
+        self.cop_window = deque()
+
+        self.defrost_start = None
+        self.defrost_starts = deque()
+
+        self.compressor = None
+
+    def update(self, data, energy_deltas):
+        def read_time(name):
+            return data.timestamps.get(name, data.timestamp)
+
+        points = []
+        heat = self.__thermal_energy(data, read_time('flow'), points)
+        consumed = self.__consumed_energy(data, read_time(CONSUMED_ENERGY[0]), energy_deltas)
+        if heat is not None or consumed is not None:
+            self.__cop(max(read_time('flow'), read_time(CONSUMED_ENERGY[0])), points)
+        self.__defrost(data, read_time('defrost_status'), points)
+        self.__compressor(data, read_time('pump_freq'), points)
+        return points
+
+    def __thermal_energy(self, data, timestamp, points):
+        power = thermal_power(data)
+        if power is None:
+            return None
+
+        heat = None
+        if self.power is not None:
+            previous, previous_power = self.power
+            if timestamp <= previous:
+                return None
+
+            seconds = elapsed(previous, timestamp)
+            if seconds is not None:
+                # Trapezoidal rule, in kWh.
+                heat = (previous_power + power) / 2 * seconds / 3600 / 1000
+                if heat:
+                    self.cop_window.append((timestamp, heat, 0))
+                    points.append(DerivedPoint('thermal_energy_delta', {'value': heat}, 'kWh', timestamp))
+
+        self.power = (timestamp, power)
+        return heat
+
+    def __consumed_energy(self, data, timestamp, energy_deltas):
+        if not any(name in energy_deltas for name in CONSUMED_ENERGY):
+            return None
+
+        # The first delta after a gap covers time in which no heat was
+        # integrated, counting it would skew the COP.
+        previous, self.consumed_at = self.consumed_at, timestamp
+        if previous is None or elapsed(previous, timestamp) is None:
+            return None
+
+        consumed = sum(energy_deltas.get(name, 0) for name in CONSUMED_ENERGY)
+        if consumed:
+            self.cop_window.append((timestamp, 0, consumed))
+        return consumed
+
+    def __cop(self, timestamp, points):
+        window = self.cop_window
+        while window and timestamp - window[0][0] > COP_WINDOW:
+            window.popleft()
+
+        heat = sum(entry[1] for entry in window)
+        consumed = sum(entry[2] for entry in window)
+        if consumed >= COP_MIN_CONSUMED:
+            points.append(DerivedPoint('cop', {'value': heat / consumed}, '', timestamp))
+
+    def __defrost(self, data, timestamp, points):
+        if data.defrost_status is None:
+            return
+
+        defrosting = data.defrost_status.code == DEFROST_STATUS
+        if defrosting and self.defrost_start is None:
+            self.defrost_start = timestamp
+        elif not defrosting and self.defrost_start is not None:
+            start, self.defrost_start = self.defrost_start, None
+
+            starts = self.defrost_starts
+            fields = {'duration': (timestamp - start).total_seconds()}
+            if starts:
+                fields['since_previous'] = (start - starts[-1]).total_seconds()
+
+            starts.append(start)
+            while timestamp - starts[0] > DEFROST_COUNT_WINDOW:
+                starts.popleft()
+            fields['count_24h'] = len(starts)
+
+            points.append(DerivedPoint('defrost', fields, 's', timestamp))
+
+    def __compressor(self, data, timestamp, points):
+        if data.pump_freq is None:
+            return
+
+        running = data.pump_freq.value > 0
+        if self.compressor is not None:
+            previous, was_running = self.compressor
+            if timestamp <= previous:
+                return
+
+            seconds = elapsed(previous, timestamp)
+            runtime = seconds if was_running and seconds is not None else 0.0
+            starts = int(running and not was_running)
+            if runtime or starts:
+                points.append(DerivedPoint('compressor', {'runtime': runtime, 'starts': starts}, 's', timestamp))
+
+        self.compressor = (timestamp, running)
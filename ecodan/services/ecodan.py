@@ -14,70 +14,364 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from dataclasses import dataclass
+import asyncio
+from dataclasses import asdict, dataclass, field, make_dataclass
 import datetime
+import time
+from types import MappingProxyType
 
-from clients.ecodan import Ecodan, EcodanFloatData, EcodanEnergyData, EcodanLutData
-
-
-@dataclass
-class EcodanDataDto:
-    timestamp: datetime
-    tank_temp: EcodanFloatData
-    tank_target_temp: EcodanFloatData
-    house_temp: EcodanFloatData
-    house_target_temp: EcodanFloatData
-    outdoor_temp: EcodanFloatData
-    pump_freq: EcodanFloatData
-    flow: EcodanFloatData
-    pump_supply_temp: EcodanFloatData
-    pump_return_temp: EcodanFloatData
-    energy_consumed_tank: EcodanEnergyData
-    energy_produced_tank: EcodanEnergyData
-    energy_consumed_house: EcodanEnergyData
-    energy_produced_house: EcodanEnergyData
-    operating_mode: EcodanLutData
-    heat_source: EcodanLutData
-    defrost_status: EcodanLutData
-    dhw_enabled: EcodanLutData
+from clients.ecodan import Ecodan, DEVICE_ERRORS, RETRYABLE_ERRORS
+from clients.register_cache import RegisterCache
+from clients.registers import SCHEMA
+from clients.samples import SampleRing
+from clients.serial_worker import SerialWorker, PRIORITY_WRITE
+from metrics import CIRCUIT_OPEN, POLL_MISSING, POLL_REGISTERS, POLL_SECONDS, POLL_SKIPPED
+from services.aggregation import WindowAggregator
+from services.broadcast import Broadcaster
+from services.circuit_breaker import CircuitBreaker, OPEN
+from services.poll_loop import PollLoop
+from services.poll_scheduler import AdaptivePollScheduler
+
+
+# Distinguishes snapshot versions of different runs in ETags.
+SNAPSHOT_EPOCH = int(time.time())
+
+HIGH_FREQUENCY_SIGNALS = ('pump_supply_temp', 'pump_return_temp', 'flow', 'pump_freq')
+
+
+# Fields that were not polled for a sample are None, 'missing' names the
+# ones that were polled but could not be read. 'timestamp' is when the first
+# register of the sample was read, 'timestamps' holds the read time of each
+# field.
+EcodanDataDto = make_dataclass(
+    'EcodanDataDto',
+    [('timestamp', datetime.datetime), ('device', str)] +
+    [(r.name, r.data_type, field(default=None)) for r in SCHEMA.registers] +
+    [('missing', tuple, field(default=())), ('timestamps', dict, field(default_factory=dict))]
+)
+
+
+def serialize(data):
+    return {k: v.isoformat() if isinstance(v, datetime.date) else v
+            for k, v in asdict(data).items()}
+
+
+@dataclass(frozen=True)
+class EcodanSnapshotField:
+    data: object
+    timestamp: datetime.datetime
+    version: int
+
+    @property
+    def etag(self):
+        return f'{self.timestamp.timestamp():.3f}-{self.version}'
+
+    def to_dict(self):
+        data = serialize(self.data)
+        data['timestamp'] = self.timestamp.isoformat()
+        return data
+
+
+@dataclass(frozen=True)
+class EcodanSnapshot:
+    version: int = 0
+    fields: MappingProxyType = field(default_factory=lambda: MappingProxyType({}))
+
+    @property
+    def etag(self):
+        return f'{SNAPSHOT_EPOCH}-{self.version}'
+
+    def changed(self, values):
+        return {name: data for name, data in values.items()
+                if name not in self.fields or self.fields[name].data != data}
+
+    def updated(self, timestamps, values):
+        if not values:
+            return self
+
+        version = self.version + 1
+        fields = dict(self.fields)
+        for name, data in values.items():
+            fields[name] = EcodanSnapshotField(data, timestamps[name], version)
+
+        return EcodanSnapshot(version, MappingProxyType(fields))
+
+    def to_dict(self, names=None):
+        if names is None:
+            names = self.fields
+        return {name: self.fields[name].to_dict() for name in names}
+
+
+class EcodanDevice:
+    def __init__(self, app, device_id, client, worker, broadcaster):
+        self.app = app
+        self.id = device_id
+        self.client = client
+        self.worker = worker
+        self.broadcaster = broadcaster
+
+        self.register_cache = RegisterCache(SCHEMA, self.read_registers)
+        self.snapshot = EcodanSnapshot()
+
+        self.poll_scheduler = AdaptivePollScheduler(
+            SCHEMA,
+            tick=self.app.config['ECODAN_POLL_INTERVAL'],
+            adaptive=self.app.config['ECODAN_POLL_ADAPTIVE']
+        )
+
+        self.hf_raw_trigger = self.app.config['ECODAN_HF_RAW_TRIGGER']
+        self.samples = SampleRing(
+            SCHEMA, HIGH_FREQUENCY_SIGNALS, capacity=self.app.config['ECODAN_HF_BUFFER'])
+        self.hf_aggregator = WindowAggregator(
+            self.samples, window=self.app.config['ECODAN_HF_WINDOW'])
+
+        self.poll_seconds = POLL_SECONDS.labels(self.id, 'poll')
+        self.hf_seconds = POLL_SECONDS.labels(self.id, 'high_frequency')
+        self.poll_registers = POLL_REGISTERS.labels(self.id)
+        self.poll_skipped = POLL_SKIPPED.labels(self.id)
+        self.circuit_open = CIRCUIT_OPEN.labels(self.id)
+
+        self.retries = self.app.config['ECODAN_RETRIES']
+        self.retry_backoff = self.app.config['ECODAN_RETRY_BACKOFF']
+        self.circuit_breaker = CircuitBreaker(
+            threshold=self.app.config['ECODAN_BREAKER_THRESHOLD'],
+            timeout=self.app.config['ECODAN_BREAKER_TIMEOUT'],
+            max_timeout=self.app.config['ECODAN_BREAKER_MAX_TIMEOUT']
+        )
+
+    def read_blocks_timed(self, plan):
+        start = time.time()
+        registers = self.client.read_blocks(plan)
+
+        # The registers were sampled somewhere during the transaction.
+        read_at = datetime.datetime.fromtimestamp((start + time.time()) / 2)
+        return registers, dict.fromkeys(registers, read_at)
+
+    async def read_blocks(self, plan):
+        return await self.worker.submit(
+            self.read_blocks_timed, plan, source=self.id,
+            retries=self.retries, backoff=self.retry_backoff, retry_on=RETRYABLE_ERRORS)
+
+    async def read_registers(self, plan):
+        # Returns the registers and the time each of them was read.
+        if self.client.pipelined:
+            try:
+                return await self.read_blocks(plan)
+            except RETRYABLE_ERRORS:
+                raise
+            except Exception:
+                # One block was refused, read the others on their own.
+                if len(plan) == 1:
+                    raise
+
+        # One worker request per block, so writes can preempt the remaining
+        # blocks and a failing block does not take the others down with it.
+        results = await asyncio.gather(
+            *(self.read_blocks((block,)) for block in plan), return_exceptions=True)
+
+        registers = {}
+        timestamps = {}
+        errors = []
+        for result in results:
+            if isinstance(result, BaseException):
+                errors.append(result)
+            else:
+                registers.update(result[0])
+                timestamps.update(result[1])
+
+        if errors and not registers:
+            raise errors[0]
+        return registers, timestamps
+
+    def poll_allowed(self, now):
+        if self.circuit_breaker.allow(now):
+            return True
+        self.poll_skipped.inc()
+        return False
+
+    async def poll_registers_partial(self, names):
+        try:
+            registers, timestamps = await self.read_registers(SCHEMA.plan_for(names))
+        except DEVICE_ERRORS as e:
+            self.circuit_breaker.failure(time.monotonic())
+            self.circuit_open.set(int(self.circuit_breaker.state == OPEN))
+            print(f'Polling {self.id} failed: {e}')
+            return None, names, {}
+
+        self.circuit_breaker.success()
+        self.circuit_open.set(0)
+
+        values, missing = SCHEMA.decode_partial(registers, names)
+        for name in missing:
+            POLL_MISSING.labels(self.id, name).inc()
+        return values, missing, SCHEMA.read_times(timestamps, values)
+
+    async def read_cached(self, names):
+        return await self.register_cache.get(names)
+
+    async def write(self, name, value):
+        start = time.monotonic()
+        try:
+            await self.worker.submit(
+                self.client.write_value, name, value, priority=PRIORITY_WRITE, source=self.id)
+        finally:
+            self.register_cache.invalidate(SCHEMA[name].address)
+            self.poll_scheduler.changed(name)
+        return (time.monotonic() - start) * 1000
+
+    async def set_tank_target_temp(self, value):
+        return await self.write('tank_target_temp', value)
+
+    async def set_house_target_temp(self, value):
+        return await self.write('house_target_temp', value)
+
+    def update_snapshot(self, timestamps, values):
+        changed = self.snapshot.changed(values)
+        self.snapshot = self.snapshot.updated(timestamps, values)
+
+        if changed:
+            self.broadcaster.publish({
+                'device': self.id,
+                'version': self.snapshot.version,
+                'fields': self.snapshot.to_dict(changed)
+            })
+
+    async def read_data_to_influx(self):
+        now = time.monotonic()
+        if not self.poll_allowed(now):
+            return
+
+        names = self.poll_scheduler.due(now)
+        if not names:
+            return
+
+        generation = self.register_cache.generation(names)
+        with self.poll_seconds.time():
+            values, missing, timestamps = await self.poll_registers_partial(names)
+            if not values:
+                return
+
+            self.poll_registers.inc(len(values))
+            # Values read before a write that overtook this poll are outdated.
+            values = self.register_cache.put(values, generation=generation)
+            if not values:
+                return
+            timestamps = {name: timestamps[name] for name in values}
+
+            self.poll_scheduler.observe(now, values)
+            self.update_snapshot(timestamps, values)
+            self.app.services.history.add(self.id, timestamps, values)
+
+            data = EcodanDataDto(
+                timestamp=min(timestamps.values()), device=self.id,
+                missing=tuple(missing), timestamps=timestamps, **values)
+
+            await self.app.services.influx.save_ecodan_data(data)
+
+    def hf_raw_triggered(self):
+        if self.hf_raw_trigger == 'always':
+            return True
+        if self.hf_raw_trigger == 'defrost':
+            return self.poll_scheduler.defrost_status == 2
+        return False
+
+    async def sample_high_frequency(self):
+        influx = self.app.services.influx
+
+        # Only sample at high rate during transients, the regular poll covers
+        # the steady state.
+        if not self.poll_scheduler.fast:
+            summary = self.hf_aggregator.flush()
+            if summary:
+                await influx.save_aggregates(self.id, *summary)
+            return
+
+        if not self.poll_allowed(time.monotonic()):
+            return
+
+        with self.hf_seconds.time():
+            values, missing, timestamps = await self.poll_registers_partial(HIGH_FREQUENCY_SIGNALS)
+            if not values:
+                return
+
+            timestamp = min(timestamps.values())
+            self.poll_registers.inc(len(values))
+            self.register_cache.put(values)
+            self.update_snapshot(timestamps, values)
+            self.app.services.history.add(self.id, timestamps, values)
+
+            summary = self.hf_aggregator.add(timestamp, values)
+            if summary:
+                await influx.save_aggregates(self.id, *summary)
+
+            if self.hf_raw_triggered():
+                await influx.save_ecodan_data(EcodanDataDto(
+                    timestamp=timestamp, device=self.id,
+                    missing=tuple(missing), timestamps=timestamps, **values))
 
 
 class EcodanService:
     def __init__(self, app):
         self.app = app
 
-        self.client = Ecodan(
-            port=self.app.config['ECODAN_SERIAL_PORT'],
-            slave=self.app.config['ECODAN_SLAVE_ADDRESS'],
-            baudrate=self.app.config['ECODAN_SERIAL_BAUDRATE']
-        )
+        self.broadcaster = Broadcaster(self.app.config['ECODAN_STREAM_BUFFER'])
+
+        # One worker per serial port: devices on different ports are polled in
+        # parallel, devices sharing an RS-485 bus take turns on its worker.
+        self.workers = {}
+        self.devices = {}
+        for config in self.app.config['ECODAN_DEVICES']:
+            # TCP gateways accept concurrent connections, so there every
+            # device gets a worker of its own.
+            key = config['port']
+            if key.startswith('tcp://'):
+                key = f"{key}#{config['slave']}"
 
+            worker = self.workers.get(key)
+            if worker is None:
+                worker = self.workers[key] = SerialWorker(name=key)
+                worker.start()
+
+            client = Ecodan(
+                port=config['port'],
+                slave=config['slave'],
+                baudrate=config['baudrate'],
+                device_id=config['id'],
+                pool_size=self.app.config['ECODAN_TCP_POOL_SIZE'],
+                timeout=self.app.config['ECODAN_TCP_TIMEOUT'],
+                serial_timeout=self.app.config['ECODAN_SERIAL_TIMEOUT']
+            )
+
+            self.devices[config['id']] = EcodanDevice(
+                self.app, config['id'], client, worker, self.broadcaster)
+
+        self.poll_loops = []
         self.__scheduled_jobs()
 
     def __scheduled_jobs(self):
-        self.app.scheduler.add_job(
-            self.read_data_to_influx, 'cron', second='0,30')
+        max_instances = self.app.config['ECODAN_POLL_MAX_INSTANCES']
 
-    async def read_data_to_influx(self):
-        data = EcodanDataDto(
-            timestamp=datetime.datetime.now(),
-            tank_temp=self.client.get_tank_temp(),
-            tank_target_temp=self.client.get_tank_target_temp(),
-            house_temp=self.client.get_house_temp(),
-            house_target_temp=self.client.get_house_target_temp(),
-            outdoor_temp=self.client.get_outdoor_temp(),
-            pump_freq=self.client.get_pump_freq(),
-            flow=self.client.get_flow(),
-            pump_supply_temp=self.client.get_pump_supply_temp(),
-            pump_return_temp=self.client.get_pump_return_temp(),
-            energy_consumed_house=self.client.get_energy_consumed_house(),
-            energy_produced_house=self.client.get_energy_produced_house(),
-            energy_consumed_tank=self.client.get_energy_consumed_tank(),
-            energy_produced_tank=self.client.get_energy_produced_tank(),
-            operating_mode=self.client.get_operating_mode(),
-            heat_source=self.client.get_heat_source(),
-            defrost_status=self.client.get_defrost_status(),
-            dhw_enabled=self.client.get_dhw_enabled()
-        )
+        for device in self.devices.values():
+            self.poll_loops.append(PollLoop(
+                f'{device.id}:poll', self.app.config['ECODAN_POLL_INTERVAL'],
+                device.read_data_to_influx, max_instances))
+
+            if self.app.config['ECODAN_HF_INTERVAL'] > 0:
+                self.poll_loops.append(PollLoop(
+                    f'{device.id}:high_frequency', self.app.config['ECODAN_HF_INTERVAL'],
+                    device.sample_high_frequency, max_instances))
+
+        for poll_loop in self.poll_loops:
+            poll_loop.start()
+
+    def device(self, device_id=None):
+        if device_id is None:
+            return next(iter(self.devices.values()))
+        return self.devices.get(device_id)
+
+    async def close(self):
+        for poll_loop in self.poll_loops:
+            await poll_loop.stop()
 
-        await self.app.services.influx.save_ecodan_data(data)
+        for worker in self.workers.values():
+            await worker.stop()
@@ -0,0 +1,99 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import time
+
+from clients.registers import SCHEMA
+from db.models.history import History, ROLLUPS
+from services.poll_loop import PollLoop
+
+
+PRUNE_INTERVAL = 600
+
+
+class HistoryService:
+    def __init__(self, app):
+        self.app = app
+
+        self.raw_retention = self.app.config['HISTORY_RAW_RETENTION'] * 3600
+        self.rollup_retention = {
+            60: self.app.config['HISTORY_MINUTE_RETENTION'] * 86400,
+            3600: self.app.config['HISTORY_HOUR_RETENTION'] * 86400
+        }
+
+        self.buffer = []
+        self.lock = asyncio.Lock()
+        self.pruned_at = 0
+
+        self.flush_loop = PollLoop('history', self.app.config['HISTORY_FLUSH_INTERVAL'], self.flush)
+        self.flush_loop.start()
+
+    async def close(self):
+        await self.flush_loop.stop()
+        await self.flush()
+
+    def add(self, device, timestamps, values):
+        for name, data in values.items():
+            self.buffer.append((device, name, timestamps[name].timestamp(), SCHEMA[name].value_of(data)))
+
+    @staticmethod
+    def aggregate(rows, size):
+        # Rows arrive in time order per register, so the last row of a bucket
+        # holds its last value.
+        buckets = {}
+        for device, name, timestamp, value in rows:
+            key = (device, name, int(timestamp // size * size))
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [value, value, value, 1, value]
+            else:
+                bucket[0] = min(bucket[0], value)
+                bucket[1] = max(bucket[1], value)
+                bucket[2] += value
+                bucket[3] += 1
+                bucket[4] = value
+
+        return [
+            {'device': device, 'name': name, 'bucket': start,
+             'min': b[0], 'max': b[1], 'sum': b[2], 'count': b[3], 'last': b[4]}
+            for (device, name, start), b in buckets.items()
+        ]
+
+    async def flush(self):
+        async with self.lock:
+            rows, self.buffer = self.buffer, []
+            if rows:
+                rows.sort(key=lambda row: row[2])
+                await History.save(rows, {size: self.aggregate(rows, size) for size in ROLLUPS})
+
+            now = time.time()
+            if now - self.pruned_at >= PRUNE_INTERVAL:
+                self.pruned_at = now
+                await History.prune(
+                    now - self.raw_retention,
+                    {size: now - retention for size, retention in self.rollup_retention.items()})
+
+    async def query(self, device, name, start, end, resolution):
+        await self.flush()
+
+        if resolution == 'raw':
+            return [{'time': t, 'value': value} for t, value in await History.raw(device, name, start, end)]
+
+        return [
+            {'time': bucket, 'min': low, 'max': high, 'mean': mean, 'last': last, 'count': count}
+            for bucket, low, high, mean, last, count in await History.rollup(resolution, device, name, start, end)
+        ]
@@ -14,10 +14,35 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from dataclasses import dataclass
 import datetime
-from db.models.energy_influx_state import EnergyInfluxState
-from clients.influx import InfluxClient
-from clients.ecodan import EcodanFloatData
+import time
+from db.models.energy_influx_state import EnergyInfluxStateCache
+from db.models.influx_publish_state import InfluxPublishStateCache
+from clients.influx import InfluxClient, InfluxWriter
+from clients.line_protocol import LineProtocolEncoder, timestamp_ns
+from clients.registers import SCHEMA, EcodanFloatData, HEARTBEAT_DEFAULT
+from metrics import INFLUX_POINTS, SAVE_SECONDS
+from services.derived import DerivedMetrics, thermal_power
+
+
+@dataclass(frozen=True)
+class DerivedStream:
+    tolerance: float
+    heartbeat: float = HEARTBEAT_DEFAULT
+
+
+THERMAL_OUTPUT_POWER = DerivedStream(tolerance=50)
+
+
+def energy_timestamp(date, read_at):
+    # Daily counters belong to the device's day, which around midnight can
+    # differ from the day of the host clock.
+    if read_at.date() == date:
+        return read_at
+    if read_at.date() > date:
+        return datetime.datetime.combine(date, datetime.time.max)
+    return datetime.datetime.combine(date, datetime.time.min)
 
 
 class InfluxService:
@@ -28,100 +53,168 @@ class InfluxService:
             host=self.app.config['INFLUX_HOST'],
             database=self.app.config['INFLUX_DATABASE'],
             username=self.app.config['INFLUX_USERNAME'],
-            password=self.app.config['INFLUX_PASSWORD']
+            password=self.app.config['INFLUX_PASSWORD'],
+            timeout=self.app.config['INFLUX_TIMEOUT']
+        )
+
+        self.writer = InfluxWriter(
+            self.client,
+            batch_size=self.app.config['INFLUX_BATCH_SIZE'],
+            flush_interval=self.app.config['INFLUX_FLUSH_INTERVAL'],
+            retry_interval=self.app.config['INFLUX_RETRY_INTERVAL']
         )
+        self.writer.start()
+
+        self.prefix = self.app.config['INFLUX_STREAM_PREFIX']
+        self.encoder = LineProtocolEncoder()
+        self.energy_states = EnergyInfluxStateCache(self.app.config['ECODAN_DEVICES'][0]['id'])
+
+        self.deadband = self.app.config['INFLUX_DEADBAND']
+        self.publish_states = InfluxPublishStateCache()
+        self.suppressed = INFLUX_POINTS.labels('deadband')
+
+        self.derived = {}
+
+        self.save_seconds = {
+            phase: SAVE_SECONDS.labels(phase) for phase in ('encode', 'energy_state', 'derived', 'sqlite')
+        }
+
+    async def close(self):
+        await self.flush_states()
+        await self.writer.stop()
+
+    async def flush_states(self):
+        # One transaction, and so one commit, for all state of a sample.
+        caches = (self.energy_states, self.publish_states)
+        if not any(cache.dirty for cache in caches):
+            return
+
+        async with self.app.db.connect() as conn:
+            for cache in caches:
+                await cache.write(conn)
+            await conn.commit()
+
+    async def publish(self, device, stream, value, timestamp, rule):
+        if not self.deadband:
+            return True
+
+        if await self.publish_states.publish(
+                f'{device}:{stream}', value, timestamp / 10**9, rule.tolerance, rule.heartbeat):
+            return True
+
+        self.suppressed.inc()
+        return False
 
     async def save_ecodan_data(self, ecodan_data):
+        start = time.perf_counter()
         data = []
+        line = self.encoder.line
+        prefix = self.prefix
+        device = ecodan_data.device
+
+        # Each point gets the time its register was read. Registers read in
+        # the same transaction share a timestamp, so they are converted once.
+        timestamps = {}
+
+        def read_time(name):
+            read_at = ecodan_data.timestamps.get(name, ecodan_data.timestamp)
+            ns = timestamps.get(read_at)
+            if ns is None:
+                ns = timestamps[read_at] = timestamp_ns(read_at)
+            return ns
 
         mapping = {
-            'ecodan2_tank_set_temp': ecodan_data.tank_target_temp,
-            'ecodan2_tank_temp': ecodan_data.tank_temp,
-            'ecodan2_house_set_temp': ecodan_data.house_target_temp,
-            'ecodan2_house_temp': ecodan_data.house_temp,
-            'ecodan2_outdoor_temp': ecodan_data.outdoor_temp,
-            'ecodan2_pump_freq': ecodan_data.pump_freq,
-            'ecodan2_flow': ecodan_data.flow,
-            'ecodan2_t_flow': ecodan_data.pump_supply_temp,
-            'ecodan2_t_return': ecodan_data.pump_return_temp
+            prefix + register.stream: (datapoint, read_time(register.name), register)
+            for register in SCHEMA.by_kind['float']
+            if (datapoint := getattr(ecodan_data, register.name)) is not None
         }
 
-        if ecodan_data.flow.value > 0:
-            dt = ecodan_data.pump_supply_temp.value - ecodan_data.pump_return_temp.value
-            flow_l_sec = ecodan_data.flow.value / 60
-            thermal_output_power = EcodanFloatData(
-                value=(dt * flow_l_sec * 4.2)*1000,
-                unit='W'
-            )
-            mapping['ecodan2_thermal_output_power'] = thermal_output_power
-
-        for stream, datapoint in mapping.items():
-            data.append({
-                'time': int(ecodan_data.timestamp.strftime('%s')) * 10**9,
-                'measurement': stream,
-                'fields': {
-                    'value': datapoint.value * 1.0
-                },
-                'tags': {
-                    'unit': datapoint.unit
-                }
-            })
+        power = thermal_power(ecodan_data)
+        if power:
+            mapping[prefix + 'thermal_output_power'] = \
+                (EcodanFloatData(value=power, unit='W'), read_time('flow'), THERMAL_OUTPUT_POWER)
+
+        for stream, (datapoint, timestamp, rule) in mapping.items():
+            if not await self.publish(device, stream, datapoint.value, timestamp, rule):
+                continue
+            data.append(line(
+                stream, (('device', device), ('unit', datapoint.unit)), datapoint.value * 1.0, timestamp))
 
         mapping_lut = {
-            'ecodan2_operating_mode': ecodan_data.operating_mode,
-            'ecodan2_heat_source': ecodan_data.heat_source,
-            'ecodan2_defrost_status': ecodan_data.defrost_status,
-            'ecodan2_dhw_enabled': ecodan_data.dhw_enabled
+            prefix + register.stream: (datapoint, read_time(register.name), register)
+            for register in SCHEMA.by_kind['lut']
+            if (datapoint := getattr(ecodan_data, register.name)) is not None
         }
 
-        for stream, datapoint in mapping_lut.items():
-            data.append({
-                'time': int(ecodan_data.timestamp.strftime('%s')) * 10**9,
-                'measurement': stream,
-                'fields': {
-                    'value': datapoint.code
-                },
-                'tags': {
-                    'description': datapoint.description
-                }
-            })
+        for stream, (datapoint, timestamp, rule) in mapping_lut.items():
+            if not await self.publish(device, stream, datapoint.code, timestamp, rule):
+                continue
+            data.append(line(
+                stream, (('description', datapoint.description), ('device', device)), datapoint.code, timestamp))
+
+        encoded = time.perf_counter()
+        self.save_seconds['encode'].observe(encoded - start)
 
         mapping_energy = {
-            'ecodan2_nrg_cons_house': ecodan_data.energy_consumed_house,
-            'ecodan2_nrg_cons_tank': ecodan_data.energy_consumed_tank,
-            'ecodan2_nrg_prod_house': ecodan_data.energy_produced_house,
-            'ecodan2_nrg_prod_tank': ecodan_data.energy_produced_tank,
+            prefix + register.stream: (register.name, datapoint,
+                                       ecodan_data.timestamps.get(register.name, ecodan_data.timestamp))
+            for register in SCHEMA.by_kind['energy']
+            if (datapoint := getattr(ecodan_data, register.name)) is not None
         }
 
-        for stream, datapoint in mapping_energy.items():
-            current_state = await EnergyInfluxState.from_stream(stream)
-
-            if current_state:
-                updated = await current_state.update_from_ecodan(datapoint)
-            else:
-                current_state = EnergyInfluxState(
-                    stream, datapoint.date, datapoint.value)
-                await current_state.save()
-                updated = True
-
-            if updated:
-                timestamp = datetime.datetime(
-                    datapoint.date.year,
-                    datapoint.date.month,
-                    datapoint.date.day,
-                    ecodan_data.timestamp.hour,
-                    ecodan_data.timestamp.minute,
-                    ecodan_data.timestamp.second)
-
-                data.append({
-                    'time': int(timestamp.strftime('%s')) * 10**9,
-                    'measurement': stream,
-                    'fields': {
-                        'value': datapoint.value
-                    },
-                    'tags': {
-                        'unit': datapoint.unit
-                    }
-                })
-
-        self.client.write_points(data)
+        energy_deltas = {}
+        for stream, (name, datapoint, read_at) in mapping_energy.items():
+            key = f'{device}:{stream}'
+            delta = await self.energy_states.update_from_ecodan(key, datapoint)
+            if delta is None:
+                continue
+
+            energy_deltas[name] = delta
+
+            tags = (('device', device), ('unit', datapoint.unit))
+            timestamp = timestamp_ns(read_at)
+
+            data.append(line(
+                stream, tags, datapoint.value, timestamp_ns(energy_timestamp(datapoint.date, read_at))))
+            data.append(line(f'{stream}_total', tags, self.energy_states.states[key].total * 1.0, timestamp))
+            if delta > 0:
+                data.append(line(f'{stream}_delta', tags, delta * 1.0, timestamp))
+
+        accumulated = time.perf_counter()
+        self.save_seconds['energy_state'].observe(accumulated - encoded)
+
+        derived = self.derived.get(device)
+        if derived is None:
+            derived = self.derived[device] = DerivedMetrics()
+
+        for point in derived.update(ecodan_data, energy_deltas):
+            data.append(self.encoder.fields_line(
+                prefix + point.stream, (('device', device), ('unit', point.unit)), point.fields,
+                timestamp_ns(point.timestamp)))
+
+        self.writer.write(data)
+
+        updated = time.perf_counter()
+        self.save_seconds['derived'].observe(updated - accumulated)
+
+        await self.flush_states()
+        self.save_seconds['sqlite'].observe(time.perf_counter() - updated)
+
+    async def save_aggregates(self, device, window_start, aggregates):
+        timestamp = timestamp_ns(window_start)
+
+        data = []
+        for name, aggregate in aggregates.items():
+            data.append(self.encoder.fields_line(
+                f'{self.prefix}{SCHEMA[name].stream}_agg',
+                (('device', device), ('unit', aggregate.unit)),
+                {
+                    'min': aggregate.min * 1.0,
+                    'max': aggregate.max * 1.0,
+                    'mean': aggregate.mean * 1.0,
+                    'last': aggregate.last * 1.0,
+                    'count': aggregate.count
+                },
+                timestamp))
+
+        self.writer.write(data)
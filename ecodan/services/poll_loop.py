@@ -0,0 +1,85 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import traceback
+
+from metrics import SCHEDULER_EVENTS
+
+
+class PollLoop:
+    # Runs 'fn' every 'interval' seconds on a fixed grid of the event loop's
+    # monotonic clock, so slow runs do not make the schedule drift. A tick
+    # is skipped while 'max_instances' runs are still busy, and ticks missed
+    # because the event loop was blocked are coalesced into a single run.
+    def __init__(self, name, interval, fn, max_instances=1):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.max_instances = max_instances
+
+        self.running = set()
+        self.task = None
+
+        self.missed = SCHEDULER_EVENTS.labels(name, 'missed')
+        self.overrun = SCHEDULER_EVENTS.labels(name, 'max_instances')
+        self.errors = SCHEDULER_EVENTS.labels(name, 'error')
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_event_loop().create_task(self.__run())
+
+    async def stop(self):
+        tasks = list(self.running)
+        if self.task is not None:
+            tasks.append(self.task)
+            self.task = None
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def __call(self):
+        try:
+            await self.fn()
+        except Exception:
+            self.errors.inc()
+            print(f'Job {self.name} failed:')
+            traceback.print_exc()
+
+    async def __run(self):
+        loop = asyncio.get_event_loop()
+        next_run = loop.time()
+
+        while True:
+            delay = next_run - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            if len(self.running) < self.max_instances:
+                task = loop.create_task(self.__call())
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+            else:
+                self.overrun.inc()
+
+            next_run += self.interval
+
+            now = loop.time()
+            if now > next_run:
+                missed = int((now - next_run) // self.interval) + 1
+                self.missed.inc(missed)
+                next_run += missed * self.interval
@@ -0,0 +1,108 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import deque
+import statistics
+
+
+# Operating modes and defrost states in which the transient registers
+# (flow, compressor frequency, supply/return temperatures, ...) move quickly.
+FAST_OPERATING_MODES = {1, 6}  # Hot water, Legionella
+FAST_DEFROST_STATUSES = {2}  # Defrost
+IDLE_OPERATING_MODES = {0}  # Stop
+
+# Registers that are only meaningful together, e.g. for the thermal output
+# power. When one of them is due, all of them are read.
+POLL_GROUPS = (
+    ('flow', 'pump_supply_temp', 'pump_return_temp'),
+)
+
+HISTORY_LENGTH = 5
+GROWTH_FACTOR = 1.5
+IDLE_GROWTH_FACTOR = 3
+
+
+class AdaptivePollScheduler:
+    def __init__(self, schema, tick, adaptive=True):
+        self.schema = schema
+        self.tick = tick
+        self.adaptive = adaptive
+
+        self.intervals = {r.name: max(tick, r.poll[0]) for r in schema.registers}
+        self.next_due = {r.name: 0 for r in schema.registers}
+        self.history = {r.name: deque(maxlen=HISTORY_LENGTH) for r in schema.registers}
+
+        self.operating_mode = None
+        self.defrost_status = None
+
+    @property
+    def fast(self):
+        return self.operating_mode in FAST_OPERATING_MODES or \
+            self.defrost_status in FAST_DEFROST_STATUSES
+
+    @property
+    def idle(self):
+        return self.operating_mode in IDLE_OPERATING_MODES and not self.fast
+
+    def due(self, now):
+        if not self.adaptive:
+            return list(self.next_due)
+
+        # Half a tick of slack, so scheduler jitter does not push a register
+        # back by a whole tick.
+        horizon = now + self.tick / 2
+        names = {name for name, due in self.next_due.items() if due <= horizon}
+
+        for group in POLL_GROUPS:
+            if names.intersection(group):
+                names.update(group)
+
+        return [name for name in self.next_due if name in names]
+
+    def observe(self, now, values):
+        if 'operating_mode' in values:
+            self.operating_mode = values['operating_mode'].code
+        if 'defrost_status' in values:
+            self.defrost_status = values['defrost_status'].code
+
+        for name, data in values.items():
+            register = self.schema[name]
+            history = self.history[name]
+            history.append(register.value_of(data))
+
+            self.intervals[name] = interval = self.__next_interval(register, history)
+            self.next_due[name] = now + interval
+
+    def changed(self, name):
+        # The register was written: read it back on the next tick and poll
+        # it at its fastest rate until it settles again.
+        register = self.schema[name]
+        self.intervals[name] = max(self.tick, register.poll[0])
+        self.next_due[name] = 0
+        self.history[name].clear()
+
+    def __next_interval(self, register, history):
+        low, high = max(self.tick, register.poll[0]), max(self.tick, register.poll[1])
+        interval = self.intervals[register.name]
+
+        if register.transient and self.fast:
+            return low
+
+        if len(history) > 1 and statistics.pstdev(history) > register.tolerance:
+            return max(low, interval / 2)
+
+        growth = IDLE_GROWTH_FACTOR if register.transient and self.idle else GROWTH_FACTOR
+        return min(high, interval * growth)
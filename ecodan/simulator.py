@@ -0,0 +1,384 @@
+# Ecodan Modbus interface
+# Copyright (C) 2023-2024  Roel Huybrechts
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Register-level Ecodan simulator for load and latency testing.
+#
+#   python ecodan/simulator.py --pty                  # Modbus RTU on a pseudo terminal
+#   python ecodan/simulator.py --tcp 5020             # Modbus TCP on port 5020
+#
+# The RTU side delays every response by its transmission time at the given
+# baud rate, both sides add device latency, jitter and can inject errors.
+
+import argparse
+import datetime
+import math
+import os
+import random
+import socketserver
+import struct
+import threading
+import time
+import tty
+
+from clients.registers import SCHEMA, decode_register, encode_register
+
+
+READ_HOLDING_REGISTERS = 3
+WRITE_SINGLE_REGISTER = 6
+WRITE_MULTIPLE_REGISTERS = 16
+
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_ADDRESS = 2
+SLAVE_DEVICE_FAILURE = 4
+
+REGISTER_COUNT = 1000
+
+
+def crc16(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return struct.pack('<H', crc)
+
+
+class ThermalModel:
+    def __init__(self, clock=None, seed=None):
+        self.clock = clock or datetime.datetime.now()
+        self.rng = random.Random(seed)
+
+        self.values = {
+            'tank_temp': 45.0,
+            'tank_target_temp': 50.0,
+            'house_temp': 20.5,
+            'house_target_temp': 21.0,
+            'outdoor_temp': 5.0,
+            'pump_freq': 0,
+            'flow': 0,
+            'pump_supply_temp': 25.0,
+            'pump_return_temp': 25.0,
+            'operating_mode': 0,
+            'heat_source': 0,
+            'defrost_status': 0,
+            'dhw_enabled': 0
+        }
+        self.energy = {r.name: 0.0 for r in SCHEMA.by_kind['energy']}
+        self.energy_date = self.clock.date()
+
+        self.running_since_defrost = 0
+        self.defrost_left = 0
+
+    def step(self, seconds):
+        v = self.values
+        self.clock += datetime.timedelta(seconds=seconds)
+        hours = seconds / 3600
+
+        day_fraction = (self.clock.hour + self.clock.minute / 60) / 24
+        v['outdoor_temp'] = 5 + 5 * math.sin((day_fraction - 0.375) * 2 * math.pi) + self.rng.gauss(0, 0.1)
+
+        mode = v['operating_mode']
+        if mode != 1 and v['dhw_enabled'] == 0 and v['tank_temp'] < v['tank_target_temp'] - 5:
+            mode = 1
+        elif mode == 1 and v['tank_temp'] >= v['tank_target_temp']:
+            mode = 0
+        elif mode != 1 and v['house_temp'] < v['house_target_temp'] - 0.3:
+            mode = 2
+        elif mode == 2 and v['house_temp'] > v['house_target_temp'] + 0.3:
+            mode = 0
+        v['operating_mode'] = mode
+
+        running = mode in (1, 2)
+        if self.defrost_left > 0:
+            self.defrost_left -= seconds
+            v['defrost_status'] = 2 if self.defrost_left > 0 else 0
+        elif running and v['outdoor_temp'] < 7:
+            self.running_since_defrost += seconds
+            if self.running_since_defrost > 45 * 60:
+                self.running_since_defrost = 0
+                self.defrost_left = 5 * 60
+                v['defrost_status'] = 2
+
+        defrosting = v['defrost_status'] == 2
+        if running:
+            target_freq = 70 if mode == 1 else 25 + 8 * max(0, 20 - v['outdoor_temp']) / 5
+            target_supply = v['tank_temp'] + 8 if mode == 1 else 30 + 0.8 * max(0, 20 - v['outdoor_temp'])
+            v['flow'] = 20
+        else:
+            target_freq = 0
+            target_supply = v['house_temp'] + 2
+            v['flow'] = 0
+
+        if defrosting:
+            target_freq, target_supply = 60, 15
+
+        # First order lag towards the targets, about a minute time constant.
+        lag = 1 - math.exp(-seconds / 60)
+        v['pump_freq'] = round(v['pump_freq'] + (target_freq - v['pump_freq']) * lag)
+        v['pump_supply_temp'] += (target_supply - v['pump_supply_temp']) * lag + self.rng.gauss(0, 0.05)
+
+        delta_t = 5 * v['pump_freq'] / 70 if v['flow'] else 0
+        v['pump_return_temp'] = v['pump_supply_temp'] - delta_t
+
+        thermal_kw = v['flow'] / 60 * 4.2 * delta_t
+        cop = max(1.5, 5 - 0.08 * (v['pump_supply_temp'] - v['outdoor_temp']))
+        electric_kw = thermal_kw / cop if v['pump_freq'] else 0
+
+        house_gain = thermal_kw if mode == 2 and not defrosting else 0
+        v['house_temp'] += hours * (house_gain * 0.5 - (v['house_temp'] - v['outdoor_temp']) * 0.05)
+        tank_gain = thermal_kw if mode == 1 and not defrosting else 0
+        v['tank_temp'] += hours * (tank_gain * 4 - (v['tank_temp'] - 20) * 0.02)
+
+        if self.clock.date() != self.energy_date:
+            self.energy_date = self.clock.date()
+            self.energy = dict.fromkeys(self.energy, 0.0)
+
+        target = 'tank' if mode == 1 else 'house'
+        self.energy[f'energy_consumed_{target}'] += electric_kw * hours
+        self.energy[f'energy_produced_{target}'] += (0 if defrosting else thermal_kw) * hours
+
+    def registers(self):
+        registers = {}
+        for register in SCHEMA.by_kind['float']:
+            value = max(self.values[register.name], 0) if not register.signed else self.values[register.name]
+            registers[register.address] = encode_register(value, register.decimals, register.signed)
+
+        for register in SCHEMA.by_kind['lut']:
+            registers[register.address] = self.values[register.name]
+
+        for register in SCHEMA.by_kind['energy']:
+            value = self.energy[register.name]
+            registers[register.kwh_address] = int(value)
+            registers[register.wh_address] = int((value - int(value)) * 100)
+            registers[register.date_address] = self.energy_date.year - 2000
+            registers[register.date_address + 1] = self.energy_date.month
+            registers[register.date_address + 2] = self.energy_date.day
+
+        return registers
+
+    def write(self, address, raw):
+        for register in SCHEMA.by_kind['float']:
+            if register.address == address and register.limits is not None:
+                value = decode_register(raw, register.decimals, register.signed)
+                register.validate(value)
+                self.values[register.name] = value
+                return
+        raise ValueError(f'Register {address} is not writable')
+
+
+class SimulatedEcodan:
+    def __init__(self, model, slave=1, baudrate=9600, latency=0.02, jitter=0.01,
+                 error_rate=0, time_scale=1, seed=None):
+        self.model = model
+        self.slave = slave
+        self.baudrate = baudrate
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.time_scale = time_scale
+        self.rng = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.last_step = time.monotonic()
+        self.transactions = 0
+
+    def advance(self):
+        now = time.monotonic()
+        elapsed = (now - self.last_step) * self.time_scale
+        self.last_step = now
+
+        # Keep the integration stable when the time scale is large.
+        while elapsed > 0:
+            self.model.step(min(elapsed, 10))
+            elapsed -= 10
+
+    def delay(self, frame_length=0):
+        # 10 bits per character on the wire (start, 8 data, stop).
+        seconds = self.latency + self.rng.uniform(0, self.jitter)
+        if self.baudrate:
+            seconds += frame_length * 10 / self.baudrate
+        time.sleep(seconds)
+
+    def inject_error(self):
+        if self.error_rate and self.rng.random() < self.error_rate:
+            return self.rng.choice(('timeout', 'corrupt', 'exception'))
+
+    def handle(self, pdu):
+        with self.lock:
+            self.transactions += 1
+            self.advance()
+
+            function_code = pdu[0]
+            try:
+                if function_code == READ_HOLDING_REGISTERS:
+                    _, address, count = struct.unpack('>BHH', pdu[:5])
+                    if address + count > REGISTER_COUNT:
+                        return bytes((function_code | 0x80, ILLEGAL_DATA_ADDRESS))
+                    registers = self.model.registers()
+                    values = [registers.get(a, 0) for a in range(address, address + count)]
+                    return struct.pack(f'>BB{count}H', function_code, 2 * count, *values)
+
+                if function_code == WRITE_SINGLE_REGISTER:
+                    _, address, raw = struct.unpack('>BHH', pdu[:5])
+                    self.model.write(address, raw)
+                    return pdu[:5]
+
+                if function_code == WRITE_MULTIPLE_REGISTERS:
+                    _, address, count, _ = struct.unpack('>BHHB', pdu[:6])
+                    for i, raw in enumerate(struct.unpack(f'>{count}H', pdu[6:6 + 2 * count])):
+                        self.model.write(address + i, raw)
+                    return struct.pack('>BHH', function_code, address, count)
+            except (ValueError, TypeError):
+                return bytes((function_code | 0x80, ILLEGAL_DATA_ADDRESS))
+
+            return bytes((function_code | 0x80, ILLEGAL_FUNCTION))
+
+
+def read_rtu_request(read):
+    head = read(2)
+    if head[1] == WRITE_MULTIPLE_REGISTERS:
+        rest = read(5)
+        rest += read(rest[-1] + 2)
+    else:
+        rest = read(6)
+    return head + rest
+
+
+def serve_rtu(devices, fd):
+    # Every device is a slave on the same bus.
+    slaves = {device.slave: device for device in devices}
+    buffer = bytearray()
+
+    def read(size):
+        while len(buffer) < size:
+            buffer.extend(os.read(fd, 256))
+        data = bytes(buffer[:size])
+        del buffer[:size]
+        return data
+
+    while True:
+        frame = read_rtu_request(read)
+        if crc16(frame[:-2]) != frame[-2:]:
+            buffer.clear()
+            continue
+        device = slaves.get(frame[0])
+        if device is None:
+            continue
+
+        error = device.inject_error()
+        response = device.handle(frame[1:-2])
+        if error == 'exception':
+            response = bytes((frame[1] | 0x80, SLAVE_DEVICE_FAILURE))
+
+        response = bytes((device.slave,)) + response
+        response += crc16(response)
+        if error == 'corrupt':
+            response = response[:-1] + bytes((response[-1] ^ 0xFF,))
+
+        device.delay(len(response))
+        if error != 'timeout':
+            os.write(fd, response)
+
+
+def open_pty():
+    controller, peripheral = os.openpty()
+    tty.setraw(controller)
+    tty.setraw(peripheral)
+    return controller, os.ttyname(peripheral)
+
+
+def tcp_handler(devices):
+    units = {device.slave: device for device in devices}
+
+    class Handler(socketserver.BaseRequestHandler):
+        def recv_exactly(self, size):
+            data = b''
+            while len(data) < size:
+                chunk = self.request.recv(size - len(data))
+                if not chunk:
+                    raise ConnectionError
+                data += chunk
+            return data
+
+        def handle(self):
+            try:
+                while True:
+                    transaction_id, _, length, unit = struct.unpack('>HHHB', self.recv_exactly(7))
+                    pdu = self.recv_exactly(length - 1)
+                    device = units.get(unit)
+                    if device is None:
+                        continue
+
+                    error = device.inject_error()
+                    response = device.handle(pdu)
+                    if error in ('exception', 'corrupt'):
+                        response = bytes((pdu[0] | 0x80, SLAVE_DEVICE_FAILURE))
+
+                    # The gateway forwards the request over its own RTU bus.
+                    device.delay(len(response) + 3)
+                    if error != 'timeout':
+                        self.request.sendall(
+                            struct.pack('>HHHB', transaction_id, 0, len(response) + 1, unit) + response)
+            except ConnectionError:
+                pass
+
+    return Handler
+
+
+def serve_tcp(devices, host, port):
+    server = socketserver.ThreadingTCPServer((host, port), tcp_handler(devices))
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated Ecodan heat pump speaking Modbus.')
+    transport = parser.add_mutually_exclusive_group(required=True)
+    transport.add_argument('--pty', action='store_true', help='serve Modbus RTU on a pseudo terminal')
+    transport.add_argument('--tcp', type=int, metavar='PORT', help='serve Modbus TCP on this port')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--slave', type=int, default=1)
+    parser.add_argument('--baudrate', type=int, default=9600, help='0 disables transmission delay')
+    parser.add_argument('--latency', type=float, default=0.02, help='device response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.01, help='maximum extra random latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of failed transactions')
+    parser.add_argument('--time-scale', type=float, default=1, help='simulated seconds per real second')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    device = SimulatedEcodan(
+        ThermalModel(seed=args.seed),
+        slave=args.slave,
+        baudrate=args.baudrate,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        time_scale=args.time_scale,
+        seed=args.seed
+    )
+
+    if args.pty:
+        fd, name = open_pty()
+        print(f'Serving Modbus RTU slave {args.slave} on {name}', flush=True)
+        serve_rtu([device], fd)
+    else:
+        server = serve_tcp([device], args.host, args.tcp)
+        print(f'Serving Modbus TCP unit {args.slave} on {args.host}:{args.tcp}', flush=True)
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()